@@ -5,6 +5,7 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
 
 # display error & bail out
 def fail(*messages):
@@ -37,7 +38,7 @@ def main():
   args = parser.parse_args()
 
   # connect to netbox
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
 
   # find device or vm
   vm_a = nb.virtualization.virtual_machines.get(name=args.host_a)
@@ -5,6 +5,9 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.alloc import IpAllocator, MacAllocator
+from netbox_tools.provision import assume_ip_gateway
 
 # display error & bail out
 def fail(*messages):
@@ -14,10 +17,6 @@ def fail(*messages):
 def warn(*messages):
   print(*messages, file=stderr)
 
-def generate_mac():
-  prefix = [0x52, 0x54, 0x00]
-  suffix = [random.randint(0,0xFF) for _ in range(3)]
-  return ':'.join(map(lambda x: "%02x" % x, [*prefix, *suffix] ))
 
 
 def main():
@@ -29,6 +28,7 @@ def main():
   parser.add_argument('-H', '--host', help='Device or VM name', required=True)
   parser.add_argument('-v', '--vlan', nargs="+", help='Interface VLAN(s)', type=int)
   parser.add_argument('-a', '--address', help='Usable IP address within given VLAN, provide the N-th address (net address + number)', type=int)
+  parser.add_argument('-F', '--free-address', help='Assign first free IP address within given VLAN (or net)', action='store_true')
   parser.add_argument('-i', '--iface', help='Interface name', required=True)
   parser.add_argument('-m', '--mac', help='Interface MAC address (xx:xx:xx:xx:xx:xx format)')
   parser.add_argument('-o', '--mode', help='Interface mode (eg. tagged, tagged-all, access. defaults to access if one vlan is specified, or tagged if more')
@@ -47,7 +47,7 @@ def main():
   args = parser.parse_args()
 
   # connect to netbox
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
 
   # find device or vm
   vm = nb.virtualization.virtual_machines.get(name=args.host)
@@ -114,7 +114,9 @@ def main():
   # validate ip no and segment
   iface_addr_masked = None
   net = None
-  if args.address != None:
+  if args.address != None and args.free_address:
+    fail('use either address or free-address argument')
+  if args.address != None or args.free_address:
     # use static prefix selection
     if not args.vlan or len(args.vlan) == 0:
       if not args.net:
@@ -130,6 +132,7 @@ def main():
     if not net:
       fail('net not found')
 
+  if args.address != None:
     # make sure this address belongs to the network
     net_addr = ipaddress.ip_network(net.prefix)
     if net_addr.num_addresses - 2 < args.address:
@@ -140,13 +143,21 @@ def main():
     iface_addr_masked = "%s/%d" % (iface_addr, net_addr.prefixlen)
 
     # make sure this address is free
-    test_addr = nb.ipam.ip_addresses.get(address=iface_addr)
-    if test_addr != None:
-        fail("address already assigned")
+    error = IpAllocator(nb, net).check(iface_addr_masked)
+    if error:
+        fail("address already assigned", error)
 
-  # generate only for virtual machine interface
+  # generate only for virtual machine interface, make sure mac is unique
+  macs = MacAllocator(nb)
+  if args.mac != None:
+    try:
+      used = macs.is_used(args.mac)
+    except ValueError:
+      fail("invalid mac address specified")
+    if used:
+      fail("interface with same mac address already exists")
   if args.mac == None and vm != None:
-    args.mac = generate_mac()
+    args.mac = macs.allocate()[0]
 
   iface_data = {
           'name': args.iface,
@@ -201,19 +212,27 @@ def main():
     iface = nb.dcim.interfaces.create(iface_data)
 
   # create ip address and assign to interface
-  if iface_addr_masked != None:
+  if iface_addr_masked != None or args.free_address:
     fqdn = args.host
     if args.fqdn:
       fqdn = args.fqdn
     ip_data = {
-            'address': iface_addr_masked,
             'family': 4,
             'assigned_object_type': iface_type,
             'assigned_object_id': iface.id,
             }
     if args.no_dns_name == False:
       ip_data['dns_name'] = fqdn
-    ip = nb.ipam.ip_addresses.create(ip_data)
+    if args.free_address:
+      ip = IpAllocator(nb, net).allocate([ip_data])[0]
+      # make sure allocated address is not gateway address
+      if ip.address.split('/')[0] == assume_ip_gateway(net.prefix):
+        ip.delete()
+        iface.delete()
+        fail("allocated gateway address! fix your netbox")
+    else:
+      ip_data['address'] = iface_addr_masked
+      ip = nb.ipam.ip_addresses.create(ip_data)
 
     if args.primary:
       if dev:
@@ -5,6 +5,7 @@ import json,yaml,os,ipaddress,random,pynetbox
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
 
 # display error & bail out
 def fail(*messages):
@@ -40,7 +41,7 @@ def main():
   if PROTO not in ['tcp','udp']:
     fail("invalid proto - use TCP or UDP")
   
-  nb = pynetbox.api(os.getenv('NETBOX_API_URL'), token=os.getenv('NETBOX_TOKEN'))
+  nb = connect(os.getenv('NETBOX_API_URL'), token=os.getenv('NETBOX_TOKEN'))
 
   # find device or vm
   vm = nb.virtualization.virtual_machines.get(name=FQDN)
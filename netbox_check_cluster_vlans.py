@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from sys import stderr,exit,argv
+import os,pynetbox,argparse,re
+from collections import defaultdict
+from netbox_tools.client import connect
+from netbox_tools.cache import Inventory
+from netbox_tools.fetch import fetch_all
+from netbox_tools.networking import fetch_interfaces, render_all
+from netbox_tools.vlans import VlanMembership
+
+doc = """
+Check that all nodes of hypervisor cluster (or site) carry same tagged VLANs
+on their trunk interfaces, that VLANs used by VMs in cluster are present on
+all nodes and that brVlanN bridges rendered by netbox_generate_networking.py
+match tagged VLANs. With --fix, missing VLANs are added with one bulk PATCH,
+exit status stays non-zero if findings --fix can't resolve remain.
+"""
+
+def fail(*messages):
+  print(*messages, file=stderr)
+  exit(1)
+
+def warn(*messages):
+  print(*messages, file=stderr)
+
+
+# interfaces carrying vlans, same as bridges in networking renderer:
+# tagged mode, not lag member
+def trunk_ifaces(ifaces, name=None):
+  return [x for x in ifaces if x.mode and x.mode.value == 'tagged' and not x.lag and (name == None or x.name == name)]
+
+def bridge_vids(res):
+  vids = set()
+  for name in res['networking']:
+    m = re.match(r'^brVlan(\d+)$', name)
+    if m:
+      vids.add(int(m.group(1)))
+  return vids
+
+
+def main():
+  parser = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
+  parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
+  parser.add_argument('-c', '--cluster', help='Cluster name')
+  parser.add_argument('-s', '--site', help='Check all devices with trunk interfaces in site (slug)')
+  parser.add_argument('-i', '--iface', help='Trunk interface name (defaults to all tagged non-LAG member interfaces)')
+  parser.add_argument('-N', '--no-networking', help='Skip cross-check with rendered brVlanN bridges', action='store_true')
+  parser.add_argument('-f', '--fix', help='Add missing VLANs to trunk interfaces with bulk PATCH', action='store_true')
+  args = parser.parse_args()
+
+  if not args.cluster and not args.site:
+    fail("cluster or site must be specified")
+
+  nb = connect(args.api_url, args.token)
+  inventory = Inventory(nb)
+
+  # nodes of cluster or site
+  filters = {}
+  cluster = None
+  if args.cluster:
+    cluster = nb.virtualization.clusters.get(name=args.cluster)
+    if not cluster:
+      fail("no such cluster", args.cluster)
+    filters['cluster_id'] = cluster.id
+  if args.site:
+    filters['site'] = args.site
+  devs = list(nb.dcim.devices.filter(**filters))
+
+  # all interfaces of all nodes in chunked bulk requests
+  ifaces = fetch_interfaces(inventory, devs, [])
+  trunks = {}
+  for dev in devs:
+    dev_trunks = trunk_ifaces(ifaces.get(('dev', dev.id), []), args.iface)
+    if dev_trunks:
+      trunks[dev.name] = dev_trunks
+    elif args.cluster:
+      warn(dev.name, "has no trunk interface")
+  if not trunks:
+    fail("no nodes with trunk interfaces found")
+  devs = [x for x in devs if x.name in trunks]
+
+  # vid -> vlan id, as seen on interfaces and vm interfaces
+  vlan_ids = defaultdict(set)
+  membership = VlanMembership(sorted(trunks))
+  for host, host_trunks in trunks.items():
+    for iface in host_trunks:
+      membership.add(host, [x.vid for x in iface.tagged_vlans])
+      for x in iface.tagged_vlans:
+        vlan_ids[x.vid].add(x.id)
+
+  # vlans of vms running in cluster must be on every node
+  vm_vids = {}
+  if cluster:
+    for iface in fetch_all(nb.virtualization.interfaces, cluster_id=cluster.id):
+      if iface.untagged_vlan:
+        vm_vids.setdefault(iface.untagged_vlan.vid, set()).add(iface.virtual_machine.name)
+        vlan_ids[iface.untagged_vlan.vid].add(iface.untagged_vlan.id)
+      for x in iface.tagged_vlans or []:
+        vm_vids.setdefault(x.vid, set()).add(iface.virtual_machine.name)
+        vlan_ids[x.vid].add(x.id)
+
+  # problems counts all findings, unfixed those --fix can't resolve
+  problems = 0
+  unfixed = 0
+  missing = membership.missing(vm_vids)
+  for vid, hosts in sorted(missing.items()):
+    problems += 1
+    reason = ("used by vms: " + ' '.join(sorted(vm_vids[vid]))) if vid in vm_vids else "present on %d of %d nodes" % (len(membership.hosts) - len(hosts), len(membership.hosts))
+    print("vlan", vid, "missing on", ' '.join(hosts), "-", reason)
+
+  # cross-check rendered bridges with vlans cluster needs on every node,
+  # as computed from membership. vlans already reported missing on node are
+  # skipped, what is left comes from config_context or other interfaces.
+  if not args.no_networking:
+    expected = set(membership.members).union(vm_vids)
+    for dev, res, error in render_all(inventory, devs, [], ifaces):
+      if error:
+        warn(dev.name, "networking can't be rendered:", *error.args)
+        continue
+      bridges = bridge_vids(res)
+      reported = set(vid for vid, hosts in missing.items() if dev.name in hosts)
+      absent = expected - bridges - reported
+      extra = bridges - expected
+      if absent:
+        problems += 1
+        unfixed += 1
+        print(dev.name, "renders no brVlan bridge for cluster vlans:", sorted(absent))
+      if extra:
+        problems += 1
+        unfixed += 1
+        print(dev.name, "renders brVlan bridges for vlans not on any node:", sorted(extra))
+
+  if not problems:
+    print(len(membership.hosts), "nodes,", len(membership.members), "vlans consistent")
+    return
+
+  if not args.fix:
+    exit(1)
+
+  # add missing vlans to trunk interface of each node, one bulk PATCH
+  updates = []
+  for host, host_trunks in trunks.items():
+    add_vids = [vid for vid, hosts in missing.items() if host in hosts]
+    if not add_vids:
+      continue
+    if len(host_trunks) != 1:
+      warn(host, "has more trunk interfaces, select one with --iface")
+      unfixed += 1
+      continue
+    ambiguous = [vid for vid in add_vids if len(vlan_ids[vid]) != 1]
+    if ambiguous:
+      warn(host, "skipping vlans with ambiguous id", ambiguous)
+      unfixed += 1
+    iface = host_trunks[0]
+    ids = set(x.id for x in iface.tagged_vlans)
+    ids.update(list(vlan_ids[vid])[0] for vid in add_vids if vid not in ambiguous)
+    updates.append({'id': iface.id, 'tagged_vlans': sorted(ids)})
+    print(host, iface.name, "adding vlans", sorted(set(add_vids) - set(ambiguous)))
+  if updates:
+    nb.dcim.interfaces.update(updates)
+  if unfixed:
+    exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 from sys import stderr,exit,argv
-import os,ipaddress,random,pynetbox,argparse,ast,re
+import os,ipaddress,random,pynetbox,argparse,ast,re,threading
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments
+from netbox_tools.alloc import UuidIndex, LunAllocator, IpAllocator, MacAllocator
+from netbox_tools.provision import Batch, ProvisionError, load_manifest, spec_from_args, rollback_objects
+from netbox_tools.pipeline import TaskGraph, TaskError, parallel
 
 # display error & bail out
 def fail(*messages):
@@ -22,11 +27,7 @@ def debug(*messages):
 def rollback(*messages):
   if len(ROLLBACK_LIST) > 0:
     warn("rolling back",len(ROLLBACK_LIST),"objects")
-  for x in ROLLBACK_LIST:
-    try:
-      x.delete()
-    except Exception as e:
-      warn("!! failed to rollback", x)
+  rollback_objects(nb, ROLLBACK_LIST)
 
   print(*messages, file=stderr)
   exit(1)
@@ -35,53 +36,27 @@ def rollback(*messages):
 def assume_ip_gateway(network):
   return str(ipaddress.ip_network(network)[1]).split('/')[0]
 
-def generate_mac():
-  prefix = [0x52, 0x54, 0x00]
-  suffix = [random.randint(0,0xFF) for _ in range(3)]
-  return ':'.join(map(lambda x: "%02x" % x, [*prefix, *suffix] ))
+def assign_lun_for_cluster(luns):
+  res = luns.allocate()
+  if not res:
+    raise ProvisionError('failed to assign lun')
+  return res[0]
 
-def assign_lun_for_cluster(nb, cluster):
-  assigned_luns = []
-  vms = nb.virtualization.virtual_machines.filter(cluster=cluster)
+def test_lun_uniqness(luns, lun, assigned_vm_id):
+  # one targeted query for vms with same lun instead of cluster scan
+  vms = luns.holders(lun)
   for vm in vms:
-    assigned_luns.append(vm.custom_fields['storage_id'])
-  for lun in range(1, 500):
-    if lun not in assigned_luns:
-      return lun
-
-  fail('failed to assign lun')
-  return None
-
-def test_lun_uniqness(nb, cluster, lun, assigned_vm_id):
-  vms = nb.virtualization.virtual_machines.filter(cluster=cluster)
-  for vm in vms:
-    if vm.custom_fields['storage_id'] == lun and vm.id != assigned_vm_id:
+    if vm.id != assigned_vm_id:
       warn('lun was assigned to different vm object...', vm)
       return False
-    if vm.id == assigned_vm_id and vm.custom_fields['storage_id'] != lun:
-      warn('vm got assigned different lun...')
-      return False
-  return True
-
-def test_uuid_uniqness(nb, uuid, short=False):
-  # build list of all uuids in short and long form
-  uuids = []
-  short_uuids = []
-  for vm in nb.virtualization.virtual_machines.all():
-    if not vm.custom_fields['uuid']:
-      warn('vm without uuid', vm.name)
-      continue
-    uuids.append(vm.custom_fields['uuid'])
-    short_uuids.append(vm.custom_fields['uuid'].split('-')[0])
-
-  # test uniqeness
-  if uuid in uuids:
+  if assigned_vm_id not in [vm.id for vm in vms]:
+    warn('vm got assigned different lun...')
     return False
-  if short:
-    if uuid.split('-')[0] in short_uuids:
-      return False
   return True
 
+def test_uuid_uniqness(uuids, uuid, short=False):
+  return not uuids.exists(uuid, short)
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
 parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
@@ -89,29 +64,74 @@ parser.add_argument('-t', '--tenant', help='Tenant name (defaults to NETBOX_DEFA
 parser.add_argument('-c', '--cluster', help='Cluster name (defaults to NETBOX_DEFAULT_CLUSTER env)', default=os.getenv('NETBOX_DEFAULT_CLUSTER'))
 parser.add_argument('-s', '--site', help='Site name (defaults to NETBOX_DEFAULT_SITE env)', default=os.getenv('NETBOX_DEFAULT_SITE'))
 parser.add_argument('--short-uuids', help='Use short UUIDs (defaults to NETBOX_SHORT_UUIDS env or False)', default=ast.literal_eval(os.getenv('NETBOX_SHORT_UUIDS', 'False')), action='store_true')
-parser.add_argument('-n', '--name', help='VM name, eg. "vm-ipam.example.com".', required=True)
+parser.add_argument('-n', '--name', help='VM name, eg. "vm-ipam.example.com".')
 parser.add_argument('-f', '--fqdn', help='FQDN associated with VMs primary IP. Defaults to VM name, if FQDN is used.')
-parser.add_argument('-r', '--ram-size', help='RAM in MBs', required=True, type=int)
+parser.add_argument('-r', '--ram-size', help='RAM in MBs', type=int)
 parser.add_argument('-C', '--cpus', help='Number of cpu cores (default 2)', default=2, type=int)
-parser.add_argument('-d', '--disk-size', help='Disk size in GBs', required=True, type=int)
+parser.add_argument('-d', '--disk-size', help='Disk size in GBs', type=int)
 parser.add_argument('-S', '--storage-type', help='[cf] Storage type. How will hypervisor access storage device. (defaults to multipath)', default='multipath', choices=['multipath', 'lvm', 'drbd'],)
-parser.add_argument('-D', '--storage-device', help='[cf] Storage device name. Must exist as device with "storage" or "cluster_node" roles under same site. Assign both devices for DRBD. (eg. "sto-1" or "srv-xxx-1")', nargs="+", required=True)
+parser.add_argument('-D', '--storage-device', help='[cf] Storage device name. Must exist as device with "storage" or "cluster_node" roles under same site. Assign both devices for DRBD. (eg. "sto-1" or "srv-xxx-1")', nargs="+")
 parser.add_argument('-P', '--storage-pool', help='[cf] Storage pool. Either vg name, or storage class. (eg. "vg0", "mixed", "fast", "slow", ...)', default='mixed')
 parser.add_argument('-L', '--storage-fixed-lun', help='[cf] Fixed LUN/DRBD Res ID assignment. Avoid using this. LUN will be automatically assigned by this script.', type=int)
-parser.add_argument('-v', '--vlan-id', help='Vlan for primary IP address (within site)', required=True, type=int)
+parser.add_argument('-v', '--vlan-id', help='Vlan for primary IP address (within site)', type=int)
 parser.add_argument('-p', '--platform', help='Platform slug (defaults to "ubuntu24")', default='ubuntu24')
 parser.add_argument('-B', '--batch', help='Run in batch mode. Don\'t ask for confirmations or rollbacks', default=False, action='store_true')
 parser.add_argument('-m', '--mac-addr', help='Manually select primary interface MAC address. By defaults generates MAC from 52:54:00 OUI')
 parser.add_argument('-i', '--ip-addr', help='Manually select IP address. By default assigns first usable and free IP from block associated with VLAN')
 parser.add_argument('-u', '--uuid', help='Manually select UUID for VM. By default automatically generates one')
+parser.add_argument('--uuid-lookup', help='Check UUID uniqueness against local index of all VMs, or with server-side cf_uuid query per candidate (defaults to NETBOX_UUID_LOOKUP env or index)', choices=['index', 'server'], default=os.getenv('NETBOX_UUID_LOOKUP', 'index'))
+parser.add_argument('-M', '--manifest', help='Create all VMs from YAML or CSV manifest. Keys are long option names (name, ram_size, disk_size, vlan_id, ...), options given on command line are defaults')
+parser.add_argument('--rollback-scope', help='In manifest mode, roll back whole batch or just failed VM (defaults to batch)', choices=['batch', 'vm'], default='batch')
+parser.add_argument('-X', '--transactional', help='Stage all objects locally, validate them right before commit, write them in few bulk requests and retry allocation on conflict', default=False, action='store_true')
+parser.add_argument('--retries', help='How many times to retry conflicting allocation in transactional mode (default 3)', default=3, type=int)
+add_fetch_arguments(parser)
 
 args = parser.parse_args()
 
+if not args.manifest:
+  for required in ('name', 'ram_size', 'disk_size', 'storage_device', 'vlan_id'):
+    if getattr(args, required) == None:
+      parser.error('the following arguments are required: --' + required.replace('_', '-'))
+
 # connect to netbox
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
 ROLLBACK_LIST = []
 
+if args.manifest or args.transactional:
+  print("pre-flight checks...")
+  try:
+    if args.manifest:
+      specs = load_manifest(args.manifest, vars(args))
+    else:
+      specs = [spec_from_args(vars(args))]
+    batch = Batch(nb, specs, ROLLBACK_LIST, args.short_uuids, args.uuid_lookup, args.rollback_scope == 'vm', args.threads, args.transactional, args.retries)
+    vms = batch.run()
+  except ProvisionError as e:
+    rollback(*e.args)
+  except Exception as e:
+    warn(e)
+    rollback("failed to create VMs")
+
+  debug("")
+  debug(f"succesfuly created {len(vms)} new vms")
+  if batch.failed:
+    warn("failed and rolled back", *batch.failed)
+  debug("")
+
+  # no questions in batch mode
+  if args.batch:
+    exit(1 if batch.failed else 0)
+
+  while True:
+    confirm = input("> last chance to rollback whole batch. rollback? [y/n] ")
+    if confirm in ('y', 'n'):
+      break
+
+  if confirm == 'y':
+    rollback('user requested rollback')
+  exit(1 if batch.failed else 0)
+
 print("pre-flight checks...")
 
 # pre-validate inputs
@@ -137,10 +157,58 @@ else:
   if len(args.storage_device) != 1:
     fail('exactly one storage device is required')
 
+if args.mac_addr and not re.match(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$', args.mac_addr):
+  fail("invalid mac address specified")
+
+# decide on name and fqdn
+fqdn = None
+if '.' not in args.name:
+  if not args.fqdn:
+    fail('name must be fqdn or --fqdn must be specified as well')
+  if '.' not in args.fqdn:
+    fail('invalid fqdn specified')
+  else:
+    fqdn = args.fqdn
+else:
+  fqdn = args.name
+
+uuids = UuidIndex(nb, args.uuid_lookup == 'server', args.threads)
+macs = MacAllocator(nb, args.threads)
+
+def pick_uuid():
+  if args.uuid:
+    # make sure uuid from user is unique
+    return args.uuid if test_uuid_uniqness(uuids, args.uuid, args.short_uuids) else None
+  # generate vm uuid
+  return uuids.generate(args.short_uuids)
+
+def pick_mac():
+  if args.mac_addr:
+    # test user supplied mac address
+    return None if macs.is_used(args.mac_addr) else args.mac_addr
+  # generate mac address unique among all interfaces
+  mac = macs.allocate()
+  return mac[0] if mac else None
+
+# all lookups are independent, run them at once
+lookups = {
+  'vm': lambda: nb.virtualization.virtual_machines.get(name=args.name),
+  'tenant': lambda: nb.tenancy.tenants.get(slug=args.tenant),
+  'site': lambda: nb.dcim.sites.get(slug=args.site),
+  'platform': lambda: nb.dcim.platforms.get(slug=args.platform),
+  'cluster': lambda: nb.virtualization.clusters.get(name=args.cluster),
+  'net': lambda: nb.ipam.prefixes.get(vlan_vid=args.vlan_id),
+  'uuid': pick_uuid,
+  'mac': pick_mac,
+}
+for storage_name in args.storage_device:
+  lookups['storage:' + storage_name] = lambda name=storage_name: nb.dcim.devices.get(name=name)
+found = parallel(lookups, args.threads)
+
 # lookup storage devices
 storage_devices = []
 for storage_name in args.storage_device:
-  storage_dev = nb.dcim.devices.get(name=storage_name)
+  storage_dev = found['storage:' + storage_name]
   if not storage_dev:
     fail("no such storage device", storage_name)
   if storage_dev.role.name not in ['Storage', 'Cluster Node', 'Hypervisor']:
@@ -155,20 +223,9 @@ if args.storage_type == 'drbd':
   if len(storage_devices) != 2:
     fail('invalid amount of storage devices found')
 
-if args.uuid:
-  # make sure uuid from user is unique
-  if not test_uuid_uniqness(nb, args.uuid, args.short_uuids):
-    fail("uuid specified is not unique")
-  vm_uuid = args.uuid
-else:
-  # generate vm uuid
-  for _ in range(0, 10):
-    vm_uuid = str(uuid4())
-    if test_uuid_uniqness(nb, vm_uuid, args.short_uuids):
-      break
-  else:
-    fail("faield to generate unique uuid")
-
+vm_uuid = found['uuid']
+if not vm_uuid:
+  fail("uuid specified is not unique" if args.uuid else "faield to generate unique uuid")
 debug("- uuid", vm_uuid)
 
 # validate storage pools against each storage/server
@@ -182,175 +239,182 @@ for storage_device in storage_devices:
   storage_devices_ids.append(storage_device.id)
 debug("-", args.disk_size,"GBs on storage pool", args.storage_pool, "storage(s)", storage_devices)
 
-# decide on name and fqdn
-fqdn = None
-if '.' not in args.name:
-  if not args.fqdn:
-    fail('name must be fqdn or --fqdn must be specified as well')
-  if '.' not in args.fqdn:
-    fail('invalid fqdn specified')
-  else:
-    fqdn = args.fqdn
-else:
-  fqdn = args.name
-
 # make sure VM does not already exist
-vm = nb.virtualization.virtual_machines.get(name=args.name)
-if vm:
+if found['vm']:
   fail("VM with speicified name already exists")
 
-# find the tenant object
-tenant = nb.tenancy.tenants.get(slug=args.tenant)
+# find the tenant, site, platform and cluster objects
+tenant = found['tenant']
 if not tenant:
   fail("no such tenant")
-
-# fint the site object
-site = nb.dcim.sites.get(slug=args.site)
+site = found['site']
 if not site:
   fail("no such site")
-
-# find the platform object
-platform = nb.dcim.platforms.get(slug=args.platform)
+platform = found['platform']
 if not platform:
   fail("no such platform")
 debug("- platform", platform)
-
-# find the cluster object
-cluster = nb.virtualization.clusters.get(name=args.cluster)
+cluster = found['cluster']
 if not cluster:
   fail("no such cluster")
 
 # find network prefix with specified vlan
-net = nb.ipam.prefixes.get(vlan_vid=args.vlan_id)
+net = found['net']
 if not net:
   fail("no such vlan")
 debug("- network", net.description)
 
-if args.mac_addr:
-  # test user supplied mac address
-  mac = args.mac_addr
-  iface = nb.virtualization.interfaces.get(mac_address=mac)
-  if iface:
-    fail("interface with same mac address already exists")
-  if not re.match(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$', mac):
-    fail("invalid mac address specified")
-else:
-  # generate and verify uniqueness of mac address
-  for _ in range(10):
-    mac = generate_mac()
-    iface = nb.virtualization.interfaces.get(mac_address=mac)
-    if not iface:
-      break
-  else:
-    fail("couldnt generate unique mac after 10 tries")
-
-ip_data = {
-  "dns_name": fqdn,
-  "tenant": tenant.id,
-  "family": 4
-}
+mac = found['mac']
+if not mac:
+  fail("interface with same mac address already exists" if args.mac_addr else "no free mac address left")
 
+ips = IpAllocator(nb, net)
 if args.ip_addr:
   # check if ip address belongs to same network as vlan and if it's free
-  available_ips = net.available_ips.list()
-  if not any(ip.address == args.ip_addr for ip in available_ips):
-    rollback("selected IP address is not valid. valid addresses are ", available_ips)
-  ip_data['address'] = args.ip_addr
-  # create requested ip 
-  ip = nb.ipam.ip_addresses.create(ip_data)
-else: 
-  # get usable ip address in the prefix and allocate it
-  ip = net.available_ips.create(ip_data)
-
-if not ip:
-  rollback("failed to allocate address")
-if args.ip_addr:
-  debug("- assigned requested address", ip)
-else:
-  debug("- assigned address", ip)
-ROLLBACK_LIST.insert(0, ip)
+  error = ips.check(args.ip_addr)
+  if error:
+    fail("selected IP address is not valid.", error)
+
+# created objects, rolled back in order: address, interface, vm
+CREATED = {}
+CREATED_LOCK = threading.Lock()
+def created(kind, obj):
+  with CREATED_LOCK:
+    CREATED[kind] = obj
+    ROLLBACK_LIST[:] = [CREATED[x] for x in ('ip', 'iface', 'vm') if x in CREATED]
+
+# creation steps. independent ones (address and vm, lun check and
+# interface) run concurrently.
+def create_ip(res):
+  ip_data = {
+    "dns_name": fqdn,
+    "tenant": tenant.id,
+    "family": 4
+  }
+  try:
+    if args.ip_addr:
+      # create requested ip
+      ip_data['address'] = ips.masked(args.ip_addr)
+      ip = ips.reserve([ip_data])[0]
+    else:
+      # get usable ip address in the prefix and allocate it
+      ip = ips.allocate([ip_data])[0]
+  except Exception as e:
+    warn(e)
+    ip = None
+  if not ip:
+    raise ProvisionError("failed to allocate address")
+  created('ip', ip)
+  if args.ip_addr:
+    debug("- assigned requested address", ip)
+  else:
+    debug("- assigned address", ip)
 
-# make sure allocated address is not gateway address
-gateway_ip = assume_ip_gateway(net.prefix)
-if ip.address.split('/')[0] == gateway_ip:
-  rollback("allocated gateway address! fix your netbox")
+  # make sure allocated address is not gateway address
+  gateway_ip = assume_ip_gateway(net.prefix)
+  if ip.address.split('/')[0] == gateway_ip:
+    raise ProvisionError("allocated gateway address! fix your netbox")
+  return ip
 
 # allocate unique storage_id, if not fixed lun specified
-lun = None
-if args.storage_fixed_lun:
-  lun = args.storage_fixed_lun
-else:
-  lun = assign_lun_for_cluster(nb, args.cluster)
-
-# create new vm
-vm_data = {
-  "name": args.name,
-  "status": 'planned',
-  "cluster": cluster.id,
-  "role": {'slug': 'server'},
-  "site": site.id,
-  "tenant": tenant.id,
-  "platform": platform.id,
-  "vcpus": args.cpus,
-  "memory": args.ram_size,
-  "disk": args.disk_size,
-  "custom_fields": {
-    "uuid": vm_uuid,
-    "storage_device": storage_devices_ids,
-    "storage_pool": args.storage_pool,
-    "storage_type": args.storage_type,
-    "storage_id": lun,
+def allocate_lun(res):
+  if args.storage_fixed_lun:
+    return args.storage_fixed_lun
+  return assign_lun_for_cluster(LunAllocator(nb, cluster.id, threads=args.threads))
+
+def create_vm(res):
+  vm_data = {
+    "name": args.name,
+    "status": 'planned',
+    "cluster": cluster.id,
+    "role": {'slug': 'server'},
+    "site": site.id,
+    "tenant": tenant.id,
+    "platform": platform.id,
+    "vcpus": args.cpus,
+    "memory": args.ram_size,
+    "disk": args.disk_size,
+    "custom_fields": {
+      "uuid": vm_uuid,
+      "storage_device": storage_devices_ids,
+      "storage_pool": args.storage_pool,
+      "storage_type": args.storage_type,
+      "storage_id": res['lun'],
+    }
   }
-}
-try:
-  vm = nb.virtualization.virtual_machines.create(vm_data)
-except Exception as e:
-  vm = None
-  warn(e)
-if not vm:
-  rollback("failed to create VM")
-ROLLBACK_LIST.append(vm)
-
-# make sure lun is still unique...
-#TODO: better race condition handling?
-if not test_lun_uniqness(nb, args.cluster, lun, vm.id):
-  rollback("potential lun conflict detected. re-run netbox_create_vm.py")
+  try:
+    vm = nb.virtualization.virtual_machines.create(vm_data)
+  except Exception as e:
+    vm = None
+    warn(e)
+  if not vm:
+    raise ProvisionError("failed to create VM")
+  created('vm', vm)
+  return vm
+
+# make sure lun is still unique. netbox has no constraint on storage_id, so
+# concurrent run may have picked same lun between allocation and creation.
+# conflict fails the graph, which rolls back everything created so far.
+# transactional mode (-X) retries with new lun instead.
+def check_lun(res):
+  if not test_lun_uniqness(LunAllocator(nb, cluster.id), res['lun'], res['vm'].id):
+    raise ProvisionError("potential lun conflict detected. re-run netbox_create_vm.py")
 
 # create "eth0" interface
-iface_data = {
-  "virtual_machine": vm.id,
-  "name": "eth0",
-  "type": 'virtual',
-  "mac_address": mac,
-  "mode": "access",
-  "untagged_vlan": net.vlan.id
-}
-try:
-  iface = nb.virtualization.interfaces.create(iface_data)
-except Exception as e:
-  iface = None
-  warn(e)
-if not iface:
-  rollback("failed to create interface")
-ROLLBACK_LIST.insert(1,iface)
-debug("- mac", mac)
+def create_iface(res):
+  iface_data = {
+    "virtual_machine": res['vm'].id,
+    "name": "eth0",
+    "type": 'virtual',
+    "mac_address": mac,
+    "mode": "access",
+    "untagged_vlan": net.vlan.id
+  }
+  try:
+    iface = nb.virtualization.interfaces.create(iface_data)
+  except Exception as e:
+    iface = None
+    warn(e)
+  if not iface:
+    raise ProvisionError("failed to create interface")
+  created('iface', iface)
+  debug("- mac", mac)
+  return iface
 
 # associate interface with vm
-ip.assigned_object_id = iface.id
-ip.assigned_object_type = "virtualization.vminterface"
-res = ip.save()
-if res == False:
-  rollback("failed to assign address to interface")
-
-# if upgrade_interval is present, set it to 30 days
-if 'upgrade_interval' in vm.custom_fields:
-  vm.custom_fields['upgrade_interval'] = 30
+def assign_ip(res):
+  ip = res['ip']
+  ip.assigned_object_id = res['iface'].id
+  ip.assigned_object_type = "virtualization.vminterface"
+  if ip.save() == False:
+    raise ProvisionError("failed to assign address to interface")
 
 # make ip address primary of our vm
-vm.primary_ip4 = ip.id
-res = vm.save()
-if res == False:
-  rollback("failed to declare ip address as primary")
+def set_primary(res):
+  vm = res['vm']
+  # if upgrade_interval is present, set it to 30 days
+  if 'upgrade_interval' in vm.custom_fields:
+    vm.custom_fields['upgrade_interval'] = 30
+  vm.primary_ip4 = res['ip'].id
+  if vm.save() == False:
+    raise ProvisionError("failed to declare ip address as primary")
+
+steps = TaskGraph(args.threads)
+steps.add('ip', create_ip)
+steps.add('lun', allocate_lun)
+steps.add('vm', create_vm, ['lun'])
+steps.add('lun_check', check_lun, ['lun', 'vm'])
+steps.add('iface', create_iface, ['vm'])
+steps.add('assign', assign_ip, ['ip', 'iface'])
+steps.add('primary', set_primary, ['vm', 'ip', 'assign', 'lun_check'])
+try:
+  steps.run()
+except TaskError as e:
+  if isinstance(e.error, ProvisionError):
+    rollback(*e.error.args)
+  warn(e.error)
+  rollback("failed to create VM")
+vm = CREATED['vm']
 
 debug("")
 debug(f"succesfuly created new vm {vm.name}")
@@ -368,4 +432,3 @@ while True:
 
 if confirm == 'y':
   rollback('user requested rollback')
-
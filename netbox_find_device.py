@@ -5,6 +5,8 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.cache import add_cache_arguments, inventory_from_args
 
 # display error & bail out
 def fail(*messages):
@@ -26,22 +28,24 @@ def main():
   parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
   parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
   parser.add_argument('-u', '--uuid', help='Display UUID custom field instead of name. (defaults to false)', action='store_true')
+  add_cache_arguments(parser)
   parser.add_argument("fqdn")
   args = parser.parse_args()
 
   FQDN = args.fqdn
 
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
+  inventory = inventory_from_args(nb, args)
 
   # check if we have vm or device with matching name
-  vm = nb.virtualization.virtual_machines.get(name=FQDN)
-  dev = nb.dcim.devices.get(name=FQDN)
+  vm = inventory.get('virtual_machines', name=FQDN)
+  dev = inventory.get('devices', name=FQDN)
   if vm or dev:
       print(FQDN)
       exit(0)
 
   # find matching services
-  services = nb.ipam.services.filter(name=FQDN, protocol="tcp", port=22)
+  services = inventory.filter('services', name=FQDN, protocol="tcp", port=22)
   if len(services) > 1:
     fail("!! too many matching services")
   if len(services) == 1:
@@ -61,7 +65,7 @@ def main():
     exit(0)
 
   # find ips with maching fqdn
-  ips = nb.ipam.ip_addresses.filter(dns_name=FQDN)
+  ips = inventory.filter('ip_addresses', dns_name=FQDN)
   #if len(ips) > 1:
   #  fail("!! too many matching ips")
   if len(ips) >= 1:
@@ -5,6 +5,8 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import projection
 
 # display error & bail out
 def fail(*messages):
@@ -30,10 +32,10 @@ def main():
   parser.add_argument('-L', '--lun', help='LUN number', required=True, type=int)
   args = parser.parse_args()
 
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
 
   # find storage device
-  storages = nb.dcim.devices.filter(name=args.storage)
+  storages = nb.dcim.devices.filter(name=args.storage, **projection(['name']))
   if len(storages) != 1:
     fail("no such storage device")
   storage = next(storages)
@@ -46,9 +48,9 @@ def main():
 
   # find vm with same cluster/storage/lun
   if args.cluster:
-    vms = nb.virtualization.virtual_machines.filter(cluster=args.cluster, cf_storage_id=args.lun, cf_storage_device=storage.id)
+    vms = nb.virtualization.virtual_machines.filter(cluster=args.cluster, cf_storage_id=args.lun, cf_storage_device=storage.id, **projection(['name']))
   else:
-    vms = nb.virtualization.virtual_machines.filter(cf_storage_id=args.lun, cf_storage_device=storage.id)
+    vms = nb.virtualization.virtual_machines.filter(cf_storage_id=args.lun, cf_storage_device=storage.id, **projection(['name']))
 
   if len(vms) == 0:
     fail("no such vm")
@@ -5,6 +5,8 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse,ast
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import projection
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -21,10 +23,10 @@ parser.add_argument('-c', '--cluster', help='Cluster name', required=True)
 parser.add_argument('--short-uuids', help='Use short UUIDs (defaults to NETBOX_SHORT_UUIDS env or False)', default=ast.literal_eval(os.getenv('NETBOX_SHORT_UUIDS', 'False')), action='store_true')
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
 # fetch all vms from cluster
-vms = nb.virtualization.virtual_machines.filter(cluster = args.cluster)
+vms = nb.virtualization.virtual_machines.filter(cluster = args.cluster, **projection(['name', 'custom_fields']))
 mps = []
 for vm in vms:
     #if vm.status != 'Active':
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 from sys import argv,stderr,exit
-import json, os, yaml, pynetbox, re, ipaddress
+import json, os, yaml, pynetbox, re, ipaddress, argparse
 from collections import defaultdict
 from pprint import pprint
+from netbox_tools.client import connect
+from netbox_tools.cache import add_cache_arguments, inventory_from_args
 
 doc = """ 
 Get config context from netbox for specified device.
@@ -23,19 +25,24 @@ def fail(*msg):
   print(*msg, file=stderr)
   exit(1)
 
-if len(argv) != 2:
-  fail("error, invalid number of args!", doc)
+parser = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
+parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
+add_cache_arguments(parser)
+parser.add_argument('fqdn')
+args = parser.parse_args()
 
-FQDN = argv[1] 
+FQDN = args.fqdn
 
-nb = pynetbox.api(os.getenv('NETBOX_API_URL'), token=os.getenv('NETBOX_TOKEN'))
+nb = connect(args.api_url, token=args.token)
+inventory = inventory_from_args(nb, args)
 
 dev = None
 vm = None
 
 # find vm or device object
-vm = nb.virtualization.virtual_machines.get(name=FQDN)
-dev = nb.dcim.devices.get(name=FQDN)
+vm = inventory.get('virtual_machines', name=FQDN)
+dev = inventory.get('devices', name=FQDN)
 
 if vm is None and dev is None:
   fail("no such device or vm")
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 from sys import stderr,exit,argv
-import os,pynetbox,argparse,yaml
+import os,pynetbox,argparse,yaml,ipaddress
+from netbox_tools.client import connect
+from netbox_tools.cache import Inventory
+from netbox_tools.addresses import ips_by_interface
 
 # display error & bail out
 def fail(*messages):
@@ -26,7 +29,7 @@ def main():
   args = parser.parse_args()
 
   # connect to netbox
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
   
   dev = nb.dcim.devices.get(name=args.host)
   if not dev:
@@ -35,6 +38,8 @@ def main():
   # build a list of vlans and assigned trunk ports
   vlan_map = {}
   ifaces = nb.dcim.interfaces.filter(device=args.host,type='virtual')
+  # all addresses of firewall at once, by interface
+  addresses = ips_by_interface(Inventory(nb), device_id=dev.id)
 
   res = []
   for iface in ifaces:
@@ -43,8 +48,8 @@ def main():
       continue
     #print(dict(iface))
     if iface.mode.value == 'access':
-      ip = nb.ipam.ip_addresses.get(interface_id=iface.id)
-      if not ip:
+      ips = addresses.get(iface.id)
+      if not ips:
         warn('interface without ip', iface)
         continue
       if not iface.untagged_vlan:
@@ -62,7 +67,7 @@ def main():
               'name': iface.name,
               'description': iface.description,
               'parent': iface.parent.name,
-              'address': ip.address,
+              'address': ips[0].address if len(ips) == 1 else [ip.address for ip in ips],
               'vlan': iface.untagged_vlan.vid,
               'role': role,
               'vdom': vdom,
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 from sys import stderr,exit,argv
-import os,pynetbox,time
+import os,pynetbox,time,argparse,json,ipaddress
 from pprint import pprint
 from itertools import chain
+from netbox_tools.client import connect
+from netbox_tools.fetch import fetch_by_ids, projection
 
 # display error & bail out
 def fail(*messages):
@@ -21,56 +23,268 @@ Generate NS zone file from netbox IPs, VMs, devices and service names.
 
 ## Usage:
 %s ZONE
+%s -o OUTPUT_DIR ZONE [ZONE ...]
+%s -o OUTPUT_DIR --all ZONE [ZONE ...]
+%s -o OUTPUT_DIR -i STATE_FILE --all ZONE [ZONE ...]
+
+""" % (argv[0], argv[0], argv[0], argv[0])
+
+
+# netbox objects are reduced to plain rows with just the fields used for
+# record building, so the same code works for one zone or a whole snapshot
+def host_row(obj):
+  row = {'name': obj.name, 'ip': None, 'ip_id': None}
+  if obj.primary_ip4 != None:
+    row['ip'] = obj.primary_ip4.address.split('/')[0]
+    row['ip_id'] = obj.primary_ip4.id
+  return row
+
+def service_row(service):
+  row = {
+    'name': service.name,
+    'ip': None,
+    'ip_id': None,
+    'virtual_machine': None,
+    'virtual_machine_name': None,
+    'device': None,
+    'device_name': None,
+    'mx': False,
+    'description': service.description,
+  }
+  for tag in service.tags:
+    if tag.slug == 'mx':
+      row['mx'] = True
+  if len(service.ipaddresses) > 0:
+    row['ip'] = service.ipaddresses[0].address.split('/')[0]
+    row['ip_id'] = service.ipaddresses[0].id
+  if service.virtual_machine:
+    row['virtual_machine'] = service.virtual_machine.id
+    row['virtual_machine_name'] = service.virtual_machine.name
+  if service.device:
+    row['device'] = service.device.id
+    row['device_name'] = service.device.name
+  return row
+
+def ip_row(ip):
+  return {
+    'dns_name': ip.dns_name or '',
+    'address': ip.address.split('/')[0],
+    'vrf': ip.vrf != None,
+  }
+
+# attributes used by host_row, service_row and ip_row
+ROW_FIELDS = {
+  'vms': projection(['name', 'primary_ip4']),
+  'devices': projection(['name', 'primary_ip4']),
+  'services': projection(['name', 'description', 'tags', 'ipaddresses', 'virtual_machine', 'device']),
+  'ips': projection(['address', 'dns_name', 'vrf']),
+}
+
+
+# zone data as used by build_forward_records/build_reverse_records
+def new_zone_data():
+  return {'vms': [], 'devices': [], 'services': [], 'ips': []}
+
+
+# query filters for objects named within zone.
+# "precise" uses case-insensitive ends-with lookups, "search" uses netbox
+# free-text q search (slow and matches the suffix anywhere in any field).
+def zone_filter(ZONE, field, query='precise'):
+  if query == 'search':
+    return ["."+ZONE], {}
+  return [], {field+'__iew': "."+ZONE}
+
+# network covered by reverse zone, eg. "2.1.10.in-addr.arpa" -> 10.1.2.0/24
+def reverse_zone_network(ZONE):
+  octets = list(reversed(ZONE.replace('.in-addr.arpa','').split('.')))
+  return ipaddress.ip_network('%s/%d' % ('.'.join(octets + ['0'] * (4 - len(octets))), 8 * len(octets)))
+
+
+def load_zone_data(nb, ZONE, query='precise'):
+  data = new_zone_data()
 
-""" % argv[0]
+  # find everything related to this DNS zone
+  args, kwargs = zone_filter(ZONE, 'name', query)
+  vms = nb.virtualization.virtual_machines.filter(*args, **kwargs, **ROW_FIELDS['vms'])
+  devices = nb.dcim.devices.filter(*args, **kwargs, **ROW_FIELDS['devices'])
+  services = nb.ipam.services.filter(*args, **kwargs, **ROW_FIELDS['services'])
+  args, kwargs = zone_filter(ZONE, 'dns_name', query)
+  ips = nb.ipam.ip_addresses.filter(*args, **kwargs, **ROW_FIELDS['ips'])
+
+  vm_ips = {}
+  dev_ips = {}
+  for vm in vms:
+    data['vms'].append(host_row(vm))
+    vm_ips[vm.id] = data['vms'][-1]['ip']
+  for dev in devices:
+    data['devices'].append(host_row(dev))
+    dev_ips[dev.id] = data['devices'][-1]['ip']
+  data['services'] = [service_row(service) for service in services]
+  data['ips'] = [ip_row(ip) for ip in ips]
+
+  # resolve primary addresses of service parents in bulk.
+  # reuse vms and devices from this zone, fetch only the missing ones.
+  missing_vm_ids = set()
+  missing_dev_ids = set()
+  for service in data['services']:
+    if service['ip']:
+      continue
+    if service['virtual_machine'] and service['virtual_machine'] not in vm_ips:
+      missing_vm_ids.add(service['virtual_machine'])
+    if service['device'] and service['device'] not in dev_ips:
+      missing_dev_ids.add(service['device'])
+  for vm in fetch_by_ids(nb.virtualization.virtual_machines, missing_vm_ids, **ROW_FIELDS['vms']):
+    vm_ips[vm.id] = host_row(vm)['ip']
+  for dev in fetch_by_ids(nb.dcim.devices, missing_dev_ids, **ROW_FIELDS['devices']):
+    dev_ips[dev.id] = host_row(dev)['ip']
+
+  return data, vm_ips, dev_ips
+
+
+# snapshot of every vm, device, service and ip address, keyed by object id
+def new_snapshot():
+  return {'vms': {}, 'devices': {}, 'services': {}, 'ips': {}}
+
+SNAPSHOT_ENDPOINTS = {
+  'vms': ('virtualization', 'virtual_machines', 'virtualization.virtualmachine', host_row),
+  'devices': ('dcim', 'devices', 'dcim.device', host_row),
+  'services': ('ipam', 'services', 'ipam.service', service_row),
+  'ips': ('ipam', 'ip_addresses', 'ipam.ipaddress', ip_row),
+}
+
+def snapshot_endpoint(nb, key):
+  app, name, _, _ = SNAPSHOT_ENDPOINTS[key]
+  return getattr(getattr(nb, app), name)
+
+# fetch every vm, device, service and ip address once, only row fields
+def load_snapshot(nb):
+  snapshot = new_snapshot()
+  for key, (_, _, _, row_fn) in SNAPSHOT_ENDPOINTS.items():
+    for obj in snapshot_endpoint(nb, key).filter(**ROW_FIELDS[key]):
+      if key == 'devices' and not obj.name:
+        continue
+      snapshot[key][obj.id] = row_fn(obj)
+  return snapshot
+
+# turn snapshot into zone data. addresses of hosts and services are taken
+# from the ip address rows, so changes of ip addresses alone are picked up.
+def snapshot_data(snapshot):
+  data = new_zone_data()
+  for key in data.keys():
+    for obj_id in sorted(snapshot[key]):
+      row = dict(snapshot[key][obj_id])
+      if row.get('ip_id') in snapshot['ips']:
+        row['ip'] = snapshot['ips'][row['ip_id']]['address']
+      elif row.get('ip_id') is not None:
+        # ip address was deleted since row was stored
+        row['ip'] = None
+      data[key].append(row)
+
+  vm_ips = {}
+  for obj_id, row in zip(sorted(snapshot['vms']), data['vms']):
+    vm_ips[obj_id] = row['ip']
+  dev_ips = {}
+  for obj_id, row in zip(sorted(snapshot['devices']), data['devices']):
+    dev_ips[obj_id] = row['ip']
+  return data, vm_ips, dev_ips
+
+def load_all_data(nb):
+  return snapshot_data(load_snapshot(nb))
+
+
+# all parent domains of name, eg. "a.b.example.com" -> "b.example.com", "example.com", "com"
+def name_suffixes(name):
+  labels = name.split('.')
+  for i in range(1, len(labels)):
+    yield '.'.join(labels[i:])
+
+# reverse zone holding address, /24 by default, eg. "10.1.2.3" -> "2.1.10.in-addr.arpa"
+def reverse_zone(address, octets=3):
+  return '.'.join(reversed(address.split('.')[:octets])) + '.in-addr.arpa'
+
+# reverse zones of /24, /16 and /8 holding ipv4 address, narrowest first
+def reverse_zones(address):
+  return [reverse_zone(address, octets) for octets in (3, 2, 1)]
+
+# name relative to zone, suffix is matched case-insensitively
+def relative_name(name, ZONE):
+  if name.lower().endswith("." + ZONE.lower()):
+    return name[:-len(ZONE) - 1]
+  return name
+
+
+# split snapshot into per-zone data. every row is visited once and matched
+# against requested zones by name suffix (forward, case-insensitive) or by
+# /24, /16 or /8 network (reverse).
+def partition_zone_data(data, zones):
+  res = {zone: new_zone_data() for zone in zones}
+  names = {zone.lower(): zone for zone in zones}
+
+  for key in ('vms', 'devices', 'services'):
+    for row in data[key]:
+      for suffix in name_suffixes(row['name'].lower()):
+        if suffix in names:
+          res[names[suffix]][key].append(row)
+
+  for row in data['ips']:
+    if row['dns_name']:
+      for suffix in name_suffixes(row['dns_name'].lower()):
+        if suffix in names:
+          res[names[suffix]]['ips'].append(row)
+    if ':' not in row['address']:
+      for zone in reverse_zones(row['address']):
+        if zone in names:
+          res[names[zone]]['ips'].append(row)
+
+  return res
+
+
+# requested zones plus /24 reverse zones of ipv4 addresses named within
+# requested forward zones, unless requested reverse zone covers them already
+def find_all_zones(data, zones):
+  forward = set(zone.lower() for zone in zones if not zone.endswith('.in-addr.arpa'))
+  reverse = set(zone.lower() for zone in zones if zone.endswith('.in-addr.arpa'))
+  res = set(zones)
+  for row in data['ips']:
+    if ':' in row['address'] or not forward.intersection(name_suffixes(row['dns_name'].lower())):
+      continue
+    if not reverse.intersection(reverse_zones(row['address'])):
+      res.add(reverse_zone(row['address']))
+  return sorted(res)
 
 
-def get_forward_records(nb, ZONE):
+def build_forward_records(data, ZONE, vm_ips, dev_ips):
   records = {}
   mx_records = []
 
-  # find everything related to this DNS zone
-  vms = nb.virtualization.virtual_machines.filter("."+ZONE)
-  devices = nb.dcim.devices.filter("."+ZONE)
-  services = nb.ipam.services.filter("."+ZONE)
-  ips = nb.ipam.ip_addresses.filter("."+ZONE)
-
   # vms and devices first
-  for obj in chain(vms,devices):
-    name = obj.name.replace("."+ZONE,"")
-    if obj.primary_ip4 == None:
-      warn("found entry without primary ip address", obj.name)
-    else:
-      records[name] = obj.primary_ip4.address.split('/')[0]
-
-  for service in services:
-    is_mx = False
-    for tag in service.tags:
-      if tag.slug == 'mx':
-        is_mx = True
-    name = service.name.replace("."+ZONE,"")
-    ip = None
-    if len(service.ipaddresses) > 0:
-      ip = service.ipaddresses[0].address.split('/')[0]
+  for obj in chain(data['vms'], data['devices']):
+    name = relative_name(obj['name'], ZONE)
+    if obj['ip'] == None:
+      warn("found entry without primary ip address", obj['name'])
     else:
-      if service.virtual_machine:
-        vm = nb.virtualization.virtual_machines.get(service.virtual_machine.id)
-        if vm.primary_ip4 == None:
-          warn("found service with vm without primary ip address", service.virtual_machine.name)
+      records[name] = obj['ip']
+
+  for service in data['services']:
+    name = relative_name(service['name'], ZONE)
+    ip = service['ip']
+    if ip == None:
+      if service['virtual_machine']:
+        if vm_ips.get(service['virtual_machine']) == None:
+          warn("found service with vm without primary ip address", service['virtual_machine_name'])
         else:
-          ip = vm.primary_ip4.address.split('/')[0]
-      if service.device:
-        dev = nb.dcim.devices.get(service.device.id)
-        if dev.primary_ip4 == None:
-          warn("found service with device without primary ip address", service.device.name)
+          ip = vm_ips[service['virtual_machine']]
+      if service['device']:
+        if dev_ips.get(service['device']) == None:
+          warn("found service with device without primary ip address", service['device_name'])
         else:
-          ip = dev.primary_ip4.address.split('/')[0]
+          ip = dev_ips[service['device']]
 
     if ip == None:
-      warn("service without ip address!", service.name)
+      warn("service without ip address!", service['name'])
 
-    if is_mx:
-      mx_records.append(service.description)
+    if service['mx']:
+      mx_records.append(service['description'])
     else:
       if name in records and records[name] != ip:
         warn("service name conflit with different address", name, records[name], "using service address", ip)
@@ -80,48 +294,74 @@ def get_forward_records(nb, ZONE):
         records[name] = ip
 
   # names not used by any services or vms or devices
-  for ip in ips:
-    if ip.vrf:
+  for ip in data['ips']:
+    if ip['vrf']:
       continue
-    name = ip.dns_name.replace("."+ZONE,"")
+    name = relative_name(ip['dns_name'], ZONE)
     if name == '':
-      warn('empty name detected', ip)
+      warn('empty name detected', ip['address'])
       continue
     if name not in records:
-      records[name] = ip.address.split('/')[0]
+      records[name] = ip['address']
     #else:
-    #  warn("ignored ipam record", ip.dns_name, ip.address)
+    #  warn("ignored ipam record", ip['dns_name'], ip['address'])
 
   return records, mx_records
 
 
-def get_reverse_records(nb, ZONE):
+# ptr names relative to zone, last octet for /24 zone, eg. "3.2" in /16 one
+def build_reverse_records(data, ZONE):
   records = {}
+  octets = 4 - reverse_zone_network(ZONE).prefixlen // 8
 
-  ip = '.'.join(reversed(ZONE.replace('.in-addr.arpa','').split('.')))
-
-  ips = nb.ipam.ip_addresses.filter(ip+".")
-
-  for ip in ips:
-    if '.' in ip.dns_name:
-      records[ip.dns_name] = int(ip.address.split('/')[0].split('.')[-1])
+  for ip in data['ips']:
+    if '.' in ip['dns_name']:
+      host = list(reversed(ip['address'].split('.')[-octets:]))
+      records[ip['dns_name']] = int(host[0]) if octets == 1 else '.'.join(host)
 
   return records
 
 
-def main():
-  # parse inputs
-  if len(argv) < 2:
-    fail("error, invalid number of args!\n%s" % doc)
+# show how many fetched rows actually belong to the zone
+def report_usage(data, ZONE):
+  if ZONE.endswith('.in-addr.arpa'):
+    net = reverse_zone_network(ZONE)
+    used = sum(1 for row in data['ips'] if ':' not in row['address'] and ipaddress.ip_address(row['address']) in net)
+    warn("ips fetched", len(data['ips']), "used", used)
+    return
+  for key in data.keys():
+    field = 'dns_name' if key == 'ips' else 'name'
+    used = sum(1 for row in data[key] if row[field].lower().endswith("."+ZONE.lower()))
+    warn(key, "fetched", len(data[key]), "used", used)
+
+
+def get_forward_records(nb, ZONE, query='precise', stats=False):
+  data, vm_ips, dev_ips = load_zone_data(nb, ZONE, query)
+  if stats:
+    report_usage(data, ZONE)
+  return build_forward_records(data, ZONE, vm_ips, dev_ips)
+
+
+def load_reverse_zone_data(nb, ZONE, query='precise'):
+  data = new_zone_data()
+  if query == 'search':
+    ip = '.'.join(reversed(ZONE.replace('.in-addr.arpa','').split('.')))
+    ips = nb.ipam.ip_addresses.filter(ip+".", **ROW_FIELDS['ips'])
+  else:
+    ips = nb.ipam.ip_addresses.filter(parent=str(reverse_zone_network(ZONE)), **ROW_FIELDS['ips'])
+  data['ips'] = [ip_row(x) for x in ips]
+  return data
 
-  ZONE = argv[1]
-  nb = pynetbox.api(os.getenv('NETBOX_API_URL'), token=os.getenv('NETBOX_TOKEN'))
+def get_reverse_records(nb, ZONE, query='precise', stats=False):
+  data = load_reverse_zone_data(nb, ZONE, query)
+  if stats:
+    report_usage(data, ZONE)
 
-  records = {}
+  return build_reverse_records(data, ZONE)
 
-  if ZONE.endswith('.in-addr.arpa'):
-    records = get_reverse_records(nb, ZONE)
-    zone_template = """
+
+def render_reverse_zone(ZONE, records, serial):
+  zone_template = """
 $ORIGIN {origin}.
 $TTL 86400
 
@@ -140,14 +380,14 @@ $TTL 120
 1 IN PTR . ;
 """
 
-    res = zone_template.format(origin=ZONE, serial=int(time.time()), zone='.'.join(list(records.items())[0][0].split('.')[1:]))
-    for host, ip_num in sorted(records.items(), key=lambda x: x[1]):
-      res += "%s IN PTR %s. ;\n" % (ip_num, host)
+  res = zone_template.format(origin=ZONE, serial=serial, zone='.'.join(list(records.items())[0][0].split('.')[1:]))
+  for host, ip_num in sorted(records.items(), key=lambda x: [int(o) for o in reversed(str(x[1]).split('.'))]):
+    res += "%s IN PTR %s. ;\n" % (ip_num, host)
+  return res
 
-    print(res)
-  else:
-    a_records, mx_records = get_forward_records(nb, ZONE)
-    zone_template = """
+
+def render_forward_zone(ZONE, a_records, mx_records, serial):
+  zone_template = """
 $ORIGIN {origin}.
 $TTL 86400
 
@@ -164,14 +404,238 @@ $TTL 120
 @ IN NS ns.{origin}.
 """
 
-    res = zone_template.format(origin=ZONE, serial=int(time.time()))
-    for value in sorted(mx_records):
-      res += "@ IN MX %s\n" % (value)
-    for host, ip in sorted(a_records.items()):
-      if ip:
-        res += "%s IN A %s\n" % (host, ip)
+  res = zone_template.format(origin=ZONE, serial=serial)
+  for value in sorted(mx_records):
+    res += "@ IN MX %s\n" % (value)
+  for host, ip in sorted(a_records.items()):
+    if ip:
+      res += "%s IN A %s\n" % (host, ip)
+  return res
+
+
+# zone content as sorted list of (name, type, value) resource records
+def forward_zone_rrs(a_records, mx_records):
+  rrs = [('@', 'MX', value) for value in mx_records]
+  rrs += [(host, 'A', ip) for host, ip in a_records.items() if ip]
+  return sorted(rrs)
 
-    print(res)
+def reverse_zone_rrs(records):
+  return sorted((str(ip_num), 'PTR', host + '.') for host, ip_num in records.items())
+
+
+# render zone from pre-loaded zone data.
+# returns zone file content and its resource records
+def render_zone(ZONE, data, vm_ips, dev_ips, serial):
+  if ZONE.endswith('.in-addr.arpa'):
+    records = build_reverse_records(data, ZONE)
+    if len(records) == 0:
+      return None, []
+    return render_reverse_zone(ZONE, records, serial), reverse_zone_rrs(records)
+  a_records, mx_records = build_forward_records(data, ZONE, vm_ips, dev_ips)
+  return render_forward_zone(ZONE, a_records, mx_records, serial), forward_zone_rrs(a_records, mx_records)
+
+
+def write_zone_file(output_dir, ZONE, res):
+  with open(os.path.join(output_dir, ZONE + '.zone'), 'w') as f:
+    f.write(res + "\n")
+
+
+# write zones to output directory from one shared snapshot. single zone
+# is loaded with targeted queries instead.
+def write_zones(nb, zones, find_all, output_dir, query='precise'):
+  if len(zones) == 1 and not find_all:
+    ZONE = zones[0]
+    if ZONE.endswith('.in-addr.arpa'):
+      data, vm_ips, dev_ips = load_reverse_zone_data(nb, ZONE, query), {}, {}
+    else:
+      data, vm_ips, dev_ips = load_zone_data(nb, ZONE, query)
+    zone_data = {ZONE: data}
+  else:
+    data, vm_ips, dev_ips = load_all_data(nb)
+    if find_all:
+      zones = find_all_zones(data, zones)
+    zone_data = partition_zone_data(data, zones)
+
+  serial = int(time.time())
+  for ZONE in zones:
+    res, _ = render_zone(ZONE, zone_data[ZONE], vm_ips, dev_ips, serial)
+    if res == None:
+      warn("skipping empty zone", ZONE)
+      continue
+    write_zone_file(output_dir, ZONE, res)
+
+
+# changelog endpoint moved from extras to core in netbox 4.1
+def changelog_endpoint(nb):
+  try:
+    nb.core.object_changes.count(id=0)
+    return nb.core.object_changes
+  except pynetbox.RequestError:
+    return nb.extras.object_changes
+
+def last_change_id(changelog):
+  for change in changelog.filter(ordering='-id', limit=1, offset=0):
+    return change.id
+  return 0
+
+
+# patch snapshot with objects changed since last_id. only changed objects
+# are re-fetched, deleted ones are dropped. returns new last change id.
+def update_snapshot(nb, changelog, snapshot, last_id):
+  object_types = {v[2]: k for k, v in SNAPSHOT_ENDPOINTS.items()}
+  changed = {key: set() for key in SNAPSHOT_ENDPOINTS}
+
+  # changes are filtered locally, changed_object_type filter takes one type only
+  for change in changelog.filter(id__gt=last_id):
+    last_id = max(last_id, change.id)
+    if change.changed_object_type in object_types:
+      changed[object_types[change.changed_object_type]].add(change.changed_object_id)
+
+  for key, obj_ids in changed.items():
+    if len(obj_ids) == 0:
+      continue
+    warn("refreshing", len(obj_ids), "changed", key)
+    # drop everything changed, re-add what still exists
+    for obj_id in obj_ids:
+      snapshot[key].pop(obj_id, None)
+    row_fn = SNAPSHOT_ENDPOINTS[key][3]
+    for obj in fetch_by_ids(snapshot_endpoint(nb, key), obj_ids, **ROW_FIELDS[key]):
+      if key == 'devices' and not obj.name:
+        continue
+      snapshot[key][obj.id] = row_fn(obj)
+
+  return last_id
+
+
+def load_state(path):
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    state = json.load(f)
+  # json object keys are strings, snapshot is keyed by ids
+  for key in state['snapshot']:
+    state['snapshot'][key] = {int(k): v for k, v in state['snapshot'][key].items()}
+  for zone in state['zones'].values():
+    zone['rrs'] = [tuple(rr) for rr in zone['rrs']]
+  return state
+
+def save_state(path, state):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(state, f)
+  os.replace(tmp_path, path)
+
+
+# rfc 2136 update script for changes between two record sets
+def nsupdate_diff(ZONE, old_rrs, new_rrs, ttl=120):
+  def fqdn(name):
+    return ZONE + '.' if name == '@' else '%s.%s.' % (name, ZONE)
+  res = "zone %s.\n" % ZONE
+  for name, rtype, value in sorted(set(old_rrs).difference(new_rrs)):
+    res += "update delete %s %s %s\n" % (fqdn(name), rtype, value)
+  for name, rtype, value in sorted(set(new_rrs).difference(old_rrs)):
+    res += "update add %s %d %s %s\n" % (fqdn(name), ttl, rtype, value)
+  res += "send\n"
+  return res
+
+
+# regenerate zones from snapshot kept in state file, refreshed from changelog.
+# serial is bumped and zone written only when its records change.
+def write_zones_incremental(nb, zones, find_all, output_dir, state_path, nsupdate=False, full=False):
+  changelog = changelog_endpoint(nb)
+
+  state = None
+  if not full:
+    state = load_state(state_path)
+  if state == None:
+    warn("no usable state, loading full snapshot")
+    state = {'last_change_id': last_change_id(changelog), 'zones': {}}
+    state['snapshot'] = load_snapshot(nb)
+  else:
+    state['last_change_id'] = update_snapshot(nb, changelog, state['snapshot'], state['last_change_id'])
+
+  data, vm_ips, dev_ips = snapshot_data(state['snapshot'])
+  if find_all:
+    zones = find_all_zones(data, zones)
+
+  zone_data = partition_zone_data(data, zones)
+  for ZONE in zones:
+    old = state['zones'].get(ZONE, {'serial': 0, 'rrs': []})
+    serial = max(int(time.time()), old['serial'] + 1)
+    res, rrs = render_zone(ZONE, zone_data[ZONE], vm_ips, dev_ips, serial)
+    zone_path = os.path.join(output_dir, ZONE + '.zone') if output_dir else None
+
+    # zone lost all records, delete them and drop stale zone file
+    if res == None:
+      if not old['rrs']:
+        warn("skipping empty zone", ZONE)
+        continue
+      warn("zone", ZONE, "is empty now, serial", serial)
+      if nsupdate:
+        print(nsupdate_diff(ZONE, old['rrs'], rrs))
+      elif os.path.exists(zone_path):
+        os.remove(zone_path)
+      state['zones'][ZONE] = {'serial': serial, 'rrs': rrs}
+      continue
+
+    if rrs == old['rrs'] and (nsupdate or os.path.exists(zone_path)):
+      continue
+
+    warn("zone", ZONE, "changed, serial", serial)
+    if nsupdate:
+      print(nsupdate_diff(ZONE, old['rrs'], rrs))
+    else:
+      write_zone_file(output_dir, ZONE, res)
+    state['zones'][ZONE] = {'serial': serial, 'rrs': rrs}
+
+  save_state(state_path, state)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
+  parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
+  parser.add_argument('-o', '--output-dir', help='Write each zone to OUTPUT_DIR/ZONE.zone instead of stdout. Required for more than one zone.')
+  parser.add_argument('-a', '--all', help='Generate also /24 reverse zones of IP addresses with DNS names within given forward zones', action='store_true')
+  parser.add_argument('-i', '--incremental', metavar='STATE_FILE', help='Keep snapshot and zone records in STATE_FILE and refresh them from NetBox changelog. Zones are rewritten only when changed.')
+  parser.add_argument('-F', '--full', help='Ignore existing state and reload full snapshot (with --incremental)', action='store_true')
+  parser.add_argument('-u', '--nsupdate', help='Print RFC 2136 nsupdate commands for changed zones instead of writing zone files (with --incremental)', action='store_true')
+  parser.add_argument('-q', '--query', help='Single zone lookup mode. "precise" uses name ends-with and parent prefix filters, "search" uses free-text search (defaults to precise)', default='precise', choices=['precise', 'search'])
+  parser.add_argument('-S', '--stats', help='Report fetched vs used object counts (single zone mode)', action='store_true')
+  parser.add_argument('zones', nargs='*', metavar='ZONE')
+  args = parser.parse_args()
+
+  if len(args.zones) == 0:
+    fail("error, invalid number of args!\n%s" % doc)
+  if args.all and all(zone.endswith('.in-addr.arpa') for zone in args.zones):
+    fail("--all requires at least one forward zone")
+  if (len(args.zones) > 1 or args.all) and not args.output_dir and not args.nsupdate:
+    fail("--output-dir is required for more than one zone")
+  if args.incremental and not args.output_dir and not args.nsupdate:
+    fail("--output-dir or --nsupdate is required for incremental mode")
+  if (args.nsupdate or args.full) and not args.incremental:
+    fail("--nsupdate and --full require --incremental")
+
+  nb = connect(args.api_url, token=args.token)
+
+  # incremental mode, patch stored snapshot from changelog
+  if args.incremental:
+    write_zones_incremental(nb, args.zones, args.all, args.output_dir, args.incremental, args.nsupdate, args.full)
+    return
+
+  # batch mode, fetch everything once and split it into zones
+  if args.output_dir:
+    write_zones(nb, args.zones, args.all, args.output_dir, args.query)
+    return
+
+  ZONE = args.zones[0]
+
+  if ZONE.endswith('.in-addr.arpa'):
+    records = get_reverse_records(nb, ZONE, args.query, args.stats)
+    print(render_reverse_zone(ZONE, records, int(time.time())))
+  else:
+    a_records, mx_records = get_forward_records(nb, ZONE, args.query, args.stats)
+    print(render_forward_zone(ZONE, a_records, mx_records, int(time.time())))
 
 if __name__ == "__main__":
   main()
@@ -2,6 +2,7 @@
 
 from sys import stderr
 import json, os, yaml, pynetbox, re, ipaddress, argparse, ast
+from netbox_tools.client import connect
 
 def warn(*msg):
   print(*msg, file=stderr)
@@ -21,7 +22,7 @@ parser.add_argument("-n", '--name', help='VM name', required=True)
 args = parser.parse_args()
 
 # connect to netbox
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
 # find vm object
 vm = nb.virtualization.virtual_machines.get(name=args.name)
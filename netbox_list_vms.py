@@ -5,6 +5,10 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, projection
+from netbox_tools.cache import add_cache_arguments, inventory_from_args
+from netbox_tools.output import add_format_arguments, field_list, write_objects
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -20,39 +24,41 @@ parser.add_argument('-t', '--tenant', help='Filter by tenant name')
 parser.add_argument('-c', '--cluster', help='Fitler by cluster name')
 parser.add_argument('-s', '--status', help='Fitler by status (eg. "decommissioning", defaults to "active")', default='active')
 parser.add_argument('-u', '--uuid', help='Display "vm-UUID" instead of name (defaults to false)', action='store_true')
-parser.add_argument('-x', '--silent', help='Don\'t show skip messages (defaults to false)', action='store_true')
+parser.add_argument('-x', '--silent', help='Don\'t show skip messages of other tenants and VMs without UUID (defaults to false)', action='store_true')
+add_format_arguments(parser, ['name'])
+add_fetch_arguments(parser)
+add_cache_arguments(parser)
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
-
-# fetch all vms
-vms = nb.virtualization.virtual_machines.all()
-ids = {}
-for vm in vms:
-  skip = []
-
-  # filtering vms by status
-  if vm.status.value != args.status:
-    skip.append(f"status {vm.status}")
-
-  # filter vms by tenant
-  if args.tenant and vm.tenant and vm.tenant.name != args.tenant:
-    skip.append(f"tenant {vm.tenant.name}")
-
-  # filtering vms by cluster
-  if args.cluster:
-    if not vm.cluster:
-      skip.append("not a cluster vm")
-    elif vm.cluster.name != args.cluster:
-      skip.append(f"cluster {vm.cluster}")
-
-  if len(skip) > 0:
-    if not args.silent:
-      for s in skip:
-        warn("# skip", vm.name, s)
-    continue
-
-  if args.uuid:
-    print(f'vm-{vm.custom_fields["uuid"]}')
-  else:
-    print(vm.name)
+nb = connect(args.api_url, args.token)
+
+# filter vms by status and cluster on server. tenant is filtered locally,
+# vms without tenant are listed as well.
+filters = {'status': args.status}
+if args.cluster:
+  cluster = nb.virtualization.clusters.get(name=args.cluster)
+  if not cluster:
+    fail("no such cluster", args.cluster)
+  filters['cluster_id'] = cluster.id
+
+fields = field_list(args, ['custom_fields.uuid'] if args.uuid else ['name'])
+# only output fields are requested, plus those needed for skipping
+filters.update(projection(fields + ['name', 'tenant', 'custom_fields']))
+
+# stream vms page by page
+def vms():
+  for vm in inventory_from_args(nb, args).iter('virtual_machines', **filters):
+    if args.tenant and vm.tenant and vm.tenant.name != args.tenant:
+      if not args.silent:
+        warn("# skip", vm.name, f"tenant {vm.tenant.name}")
+      continue
+    if args.uuid and not vm.custom_fields.get('uuid'):
+      if not args.silent:
+        warn("# skip", vm.name, "no uuid")
+      continue
+    yield vm
+
+text = None
+if args.uuid and not args.fields:
+  text = lambda vm: f'vm-{vm.custom_fields["uuid"]}'
+write_objects(vms(), args.format, fields, text)
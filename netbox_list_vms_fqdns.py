@@ -5,6 +5,10 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, projection
+from netbox_tools.cache import add_cache_arguments, inventory_from_args
+from netbox_tools.output import add_format_arguments, field_list, write_objects
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -16,21 +20,30 @@ def warn(*messages):
 parser = argparse.ArgumentParser()
 parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
 parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
-parser.add_argument('-t', '--tenant', help='Tenant name (defaults to NETBOX_DEFAULT_TENANT env)', default=os.getenv('NETBOX_DEFAULT_TENANT'))
+parser.add_argument('-t', '--tenant', help='Filter by tenant name (defaults to NETBOX_DEFAULT_TENANT env)', default=os.getenv('NETBOX_DEFAULT_TENANT'))
 parser.add_argument('-c', '--cluster', help='Fitler by cluster name')
 parser.add_argument('-s', '--status', help='Fitler by status (eg. "decommissioning", defaults to "active")', default='active')
+add_format_arguments(parser, ['custom_fields.fqdn'])
+add_fetch_arguments(parser)
+add_cache_arguments(parser)
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
-# fetch all vms
-vms = nb.virtualization.virtual_machines.all()
-ids = {}
-for vm in vms:
-  if vm.status.value != args.status:
-    continue
-  # filtering vms by cluster
-  if args.cluster and vm.cluster['name'] != args.cluster:
-    continue
+# filter vms by status and cluster on server. tenant is filtered locally,
+# vms without tenant are listed as well.
+filters = {'status': args.status}
+if args.cluster:
+  cluster = nb.virtualization.clusters.get(name=args.cluster)
+  if not cluster:
+    fail("no such cluster", args.cluster)
+  filters['cluster_id'] = cluster.id
 
-  print(vm.custom_fields['fqdn'])
+fields = field_list(args, ['custom_fields.fqdn'])
+filters.update(projection(fields + ['tenant']))
+
+# stream vms page by page
+vms = inventory_from_args(nb, args).iter('virtual_machines', **filters)
+if args.tenant:
+  vms = (vm for vm in vms if not vm.tenant or vm.tenant.name == args.tenant)
+write_objects(vms, args.format, fields)
@@ -2,6 +2,7 @@
 
 from sys import stderr,exit,argv
 import os,pynetbox,argparse
+from netbox_tools.client import connect
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -18,7 +19,7 @@ def main():
 
   args = parser.parse_args()
 
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
 
   # find device
   dev = nb.dcim.devices.get(name=args.host)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 from sys import stderr,exit,argv
-import os,pynetbox,argparse
+import os,pynetbox,argparse,fnmatch,re
+from collections import defaultdict
+from netbox_tools.client import connect
+from netbox_tools.fetch import chunks, projection
+from netbox_tools.vlans import resolve_vids, vlan_scope
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -9,33 +13,150 @@ def fail(*messages):
 
 def warn(*messages):
   print(*messages, file=stderr)
-  exit(1)
 
 
-def iface_ensure_mode(iface, mode, override, dry_run=False):
+# new mode of interface, or None if it is already set correctly
+def iface_ensure_mode(host, iface, mode, override, dry_run=False):
   # check if interface has a mode
   if not iface.mode:
     if not override:
-      fail('interface mode not set', iface.name)
-    iface.mode = mode
+      fail('interface mode not set', host, iface.name)
     if dry_run:
-      warn('missing interface mode on', iface.name,'will set to', mode)
-      return
-    iface.save()
-    return
+      warn('missing interface mode on', host, iface.name,'will set to', mode)
+    return mode
 
   # make sure mode is correct
   if iface.mode.value != mode:
-    if override:
-      old_mode = iface.mode
-      iface.mode = mode
-      if not dry_run:
-        warn('invalid interface mode on', iface.name, 'will change from', old_mode, 'to', mode)
-        iface.save()
-      else:
-        warn('interface mode on', iface.name, 'changed from', old_mode, 'to', mode)
+    if not override:
+      fail('invalid interface mode', host, iface.name, 'expected mode', mode, 'got', iface.mode)
+    if not dry_run:
+      warn('invalid interface mode on', host, iface.name, 'will change from', iface.mode, 'to', mode)
     else:
-      fail('invalid interface mode', iface.name, 'expected mode', mode, 'got', iface.mode)
+      warn('interface mode on', host, iface.name, 'changed from', iface.mode, 'to', mode)
+    return mode
+  return None
+
+
+def parse_vids(vlans):
+  requested_vids = set()
+  if not vlans or vlans.lower() == 'none':
+    return requested_vids
+  for vlan_range in vlans.split(','):
+    if len(vlan_range) == 0:
+        continue
+    lo_hi = vlan_range.split('-')
+    if len(lo_hi) > 1:
+      requested_vids.update(range(int(lo_hi[0]), int(lo_hi[1])+1))
+    else:
+      requested_vids.add(int(lo_hi[0]))
+  return requested_vids
+
+# vid -> vlan id of requested vlans
+def resolve_vlans(nb, requested_vids, site=None, group=None):
+  vid_ids, duplicates, missing_vids = resolve_vids(nb, requested_vids, site, group)
+
+  for vid, vlans in sorted(duplicates.items()):
+    warn("vlan", vid, "exists more than once:", ', '.join("%s (%s)" % (x.name, vlan_scope(x)) for x in vlans))
+  if duplicates:
+    fail("ambiguous vlans", set(duplicates), "use --site or --vlan-group to narrow scope")
+
+  if len(missing_vids) != 0:
+    fail("requested non-existing vlans", missing_vids)
+  return vid_ids
+
+
+# devices and vms matching host name, glob pattern, cluster or role
+def find_hosts(nb, args):
+  filters = {}
+  if args.host:
+    filters['name'] = args.host
+  if args.pattern:
+    # narrow down on server by literal prefix of pattern
+    prefix = re.split(r'[*?\[]', args.pattern)[0]
+    if prefix:
+      filters['name__isw'] = prefix
+  if args.cluster:
+    cluster = nb.virtualization.clusters.get(name=args.cluster)
+    if not cluster:
+      fail("no such cluster", args.cluster)
+    filters['cluster_id'] = cluster.id
+  if args.role:
+    filters['role'] = args.role
+
+  filters.update(projection(['name']))
+  devs = list(nb.dcim.devices.filter(**filters))
+  vms = list(nb.virtualization.virtual_machines.filter(**filters))
+  if args.pattern:
+    devs = [x for x in devs if fnmatch.fnmatchcase(x.name, args.pattern)]
+    vms = [x for x in vms if fnmatch.fnmatchcase(x.name, args.pattern)]
+  return devs, vms
+
+# interfaces with given name of all hosts, [(host name, iface), ...]
+def find_ifaces(endpoint, hosts, host_key, name):
+  names = {x.id: x.name for x in hosts}
+  res = []
+  for ids in chunks(names.keys()):
+    for iface in endpoint.filter(**{host_key + '_id': ids, 'name': name}):
+      res.append((names[getattr(iface, host_key).id], iface))
+  return res
+
+
+# changes of one interface as bulk PATCH item, None if nothing changes
+def iface_update(host, iface, args, requested_vids, vid_ids, report):
+  update = {}
+  # make sure interface mode is correct
+  mode = iface_ensure_mode(host, iface, 'tagged' if args.vlans else 'access', args.set_mode, args.no_change)
+  if mode:
+    update['mode'] = mode
+
+  # tagged interface
+  if args.vlans:
+    iface_vids = set(x.vid for x in iface.tagged_vlans)
+    iface_ids = set(x.id for x in iface.tagged_vlans)
+    wanted_vids = set(requested_vids)
+    wanted_ids = set(vid_ids[x] for x in requested_vids)
+    if args.add:
+      wanted_vids.update(iface_vids)
+      wanted_ids.update(iface_ids)
+
+    # check if we need to do something
+    if iface_vids != wanted_vids:
+      update['tagged_vlans'] = sorted(wanted_ids)
+      removed_vids = iface_vids.difference(wanted_vids)
+      added_vids = wanted_vids.difference(iface_vids)
+      for vid in added_vids:
+        report['added'][vid].append(host)
+      for vid in removed_vids:
+        report['removed'][vid].append(host)
+      if not args.summary:
+        if added_vids:
+          print(host, iface.name, "will add vlans:" if args.no_change else "added vlans:", added_vids)
+        if removed_vids:
+          print(host, iface.name, "will remove vlans:" if args.no_change else "removed vlans:", removed_vids)
+
+  # access interface
+  if args.access_vlan:
+    access_vid = list(requested_vids)[0]
+    if not iface.untagged_vlan or iface.untagged_vlan.id != vid_ids[access_vid]:
+      update['untagged_vlan'] = vid_ids[access_vid]
+      report['added'][access_vid].append(host)
+      if args.no_change and not args.summary:
+        print(host, iface.name, "set access vlan to", access_vid)
+
+  if not update:
+    if not args.summary:
+      print(host, iface.name, 'no change')
+    return None
+  update['id'] = iface.id
+  return update
+
+
+def print_report(report, changed, total, dry_run):
+  verb = "will change" if dry_run else "changed"
+  print(changed, "of", total, "interfaces", verb)
+  for action in ('added', 'removed'):
+    for vid, hosts in sorted(report[action].items()):
+      print(" vlan", vid, action if not dry_run else "to be " + action, "on", len(hosts), "hosts:", ' '.join(sorted(hosts)))
 
 
 def main():
@@ -43,14 +164,20 @@ def main():
   parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
   parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
   parser.add_argument('-t', '--tenant', help='Tenant name (defaults to NETBOX_DEFAULT_TENANT env)', default=os.getenv('NETBOX_DEFAULT_TENANT'))
-  parser.add_argument('-s', '--site', help='Site name (defaults to NETBOX_DEFAULT_SITE evn)', default=os.getenv('NETBOX_DEFAULT_SITE'))
-  parser.add_argument('-H', '--host', help='Device or VM name', required=True)
+  parser.add_argument('-s', '--site', help='Site slug (defaults to NETBOX_DEFAULT_SITE evn)', default=os.getenv('NETBOX_DEFAULT_SITE'))
+  parser.add_argument('-G', '--all-sites', help='Look up VLANs in all sites instead of just site and global ones', action='store_true')
+  parser.add_argument('-g', '--vlan-group', help='Look up VLANs only within VLAN group (slug)')
+  parser.add_argument('-H', '--host', help='Device or VM name')
+  parser.add_argument('-p', '--pattern', help='Device or VM name pattern, eg. "srv-prod-*"')
+  parser.add_argument('-c', '--cluster', help='All devices and VMs in cluster')
+  parser.add_argument('-r', '--role', help='All devices and VMs with role (slug)')
   parser.add_argument('-i', '--iface', help='Interface name', required=True)
   parser.add_argument('-a', '--add', help='Add VLANs to existing ones instead of replacing them. (defaults to false)', action='store_true')
   parser.add_argument('-x', '--set-mode', help='Override interface mode to either access or tagged. (defaults to false)', action='store_true')
   parser.add_argument('-V', '--vlans', help='VLAN list in Cisco compatible notation. eg. 1-9,20,30-39')
   parser.add_argument('-v', '--access-vlan', help='Access VLAN number eg. 123')
   parser.add_argument('-n', '--no-change', help='Don\'t change anything in netbox, just show what would be done', action='store_true')
+  parser.add_argument('-S', '--summary', help='Print only aggregated report instead of line per interface', action='store_true')
 
   args = parser.parse_args()
 
@@ -60,112 +187,50 @@ def main():
   if args.vlans and args.access_vlan:
     fail("vlans and access-vlan are mutally exclusive")
 
-  nb = pynetbox.api(args.api_url, args.token)
+  if not (args.host or args.pattern or args.cluster or args.role):
+    fail("host, pattern, cluster or role must be specified")
+
+  nb = connect(args.api_url, args.token)
 
-  # find device or vm
-  dev = nb.dcim.devices.get(name=args.host)
-  vm = nb.virtualization.virtual_machines.get(name=args.host)
+  # find devices or vms
+  devs, vms = find_hosts(nb, args)
 
   # make sure device or vm exists
-  if vm == None and dev == None:
+  if len(devs) == 0 and len(vms) == 0:
     fail("no such vm or device")
-  assert not (vm != None and dev != None)
-
-  # find interface
-  if vm != None:
-    ifaces = nb.virtualization.interfaces.filter(virtual_machine=args.host, name=args.iface)
-  if dev != None:
-    ifaces = nb.dcim.interfaces.filter(device=args.host, name=args.iface)
-  if len(ifaces) == 0:
-    fail(args.host, args.iface, "interface does not exist")
-
-  requested_vids = set()
-
-  # parse trunk vlans
-  if args.vlans and args.vlans.lower() != 'none':
-    vlan_ranges = args.vlans.split(',')
-    for vlan_range in vlan_ranges:
-      if len(vlan_range) == 0:
-          continue
-      lo_hi = vlan_range.split('-')
-      if len(lo_hi) > 1:
-        requested_vids.update(range(int(lo_hi[0]), int(lo_hi[1])+1))
-      else:
-        requested_vids.add(int(lo_hi[0]))
-
+  if args.host:
+    assert not (len(vms) != 0 and len(devs) != 0)
+
+  # find interfaces of all hosts in bulk
+  dev_ifaces = find_ifaces(nb.dcim.interfaces, devs, 'device', args.iface)
+  vm_ifaces = find_ifaces(nb.virtualization.interfaces, vms, 'virtual_machine', args.iface)
+  if len(dev_ifaces) == 0 and len(vm_ifaces) == 0:
+    fail(args.host or args.pattern or args.cluster or args.role, args.iface, "interface does not exist")
+  found_hosts = set(host for host, _ in dev_ifaces + vm_ifaces)
+  for host in sorted(set(x.name for x in devs + vms).difference(found_hosts)):
+    warn(host, args.iface, "interface does not exist")
+
+  requested_vids = parse_vids(args.vlans)
   # parse access vlan
   if args.access_vlan:
     requested_vids.add(int(args.access_vlan))
-
-  # get all vlans from the site
-  site_vlans = nb.ipam.vlans.filter() #site=args.site)
-
-  site_vids = []
-  found_vids = set()
-  requested_ids = set()
-  for site_vlan in site_vlans:
-    for vid in requested_vids:
-      if vid == site_vlan.vid:
-        found_vids.add(vid)
-        requested_ids.add(site_vlan.id)
-
-  missing_vids = requested_vids.difference(found_vids)
-  if len(missing_vids) != 0:
-    fail("requested non-existing vlans", missing_vids)
-
-  for iface in ifaces:
-    # make sure interface mode is correct
-    if args.vlans:
-      iface_ensure_mode(iface, 'tagged', args.set_mode, args.no_change)
-    if args.access_vlan:
-      iface_ensure_mode(iface, 'access', args.set_mode, args.no_change)
-
-    # tagged interface
-    if args.vlans:
-      iface_vids = set()
-      iface_ids = set()
-
-      # update tagged interfaces
-      for iface_vlan in iface.tagged_vlans:
-        iface_vids.add(iface_vlan.vid)
-        iface_ids.add(iface_vlan.id)
-      if args.add:
-        requested_ids.update(iface_ids)
-        requested_vids.update(iface_vids)
-
-      # check if we need to do something
-      if iface_vids != requested_vids:
-        iface.tagged_vlans = list(requested_ids)
-        removed_vids = set(iface_vids).difference(set(requested_vids))
-        added_vids = set(requested_vids).difference(set(iface_vids))
-
-        # if we do, and we want to...
-        if not args.no_change:
-          if added_vids:
-            print(args.host, iface.name, "added vlans:", added_vids)
-          if removed_vids:
-            print(args.host, iface.name, "removed vlans:", removed_vids)
-          iface.save()
-        else:
-          if added_vids:
-            print(args.host, iface.name, "will add vlans:", added_vids)
-          if removed_vids:
-            print(args.host, iface.name, "will remove vlans:", removed_vids)
-      else:
-        print(args.host, iface.name, 'no change')
-
-    # access interface
-    if args.access_vlan:
-      access_id = list(requested_ids)[0]
-      access_vid = list(requested_vids)[0]
-      if iface.untagged_vlan != access_id:
-        if args.no_change:
-          print(args.host, iface.name, "set access vlan to", access_vid)
-        else:
-          iface.untagged_vlan = access_id
-          iface.save()
-      else:
-        print(args.host, iface.name, 'no change')
+  vid_ids = resolve_vlans(nb, requested_vids, None if args.all_sites else args.site, args.vlan_group)
+
+  # compute all changes in memory
+  report = {'added': defaultdict(list), 'removed': defaultdict(list)}
+  updates = []
+  for endpoint, ifaces in ((nb.dcim.interfaces, dev_ifaces), (nb.virtualization.interfaces, vm_ifaces)):
+    items = [iface_update(host, iface, args, requested_vids, vid_ids, report) for host, iface in ifaces]
+    updates.append((endpoint, [x for x in items if x]))
+
+  # one bulk PATCH per interface endpoint
+  if not args.no_change:
+    for endpoint, items in updates:
+      if items:
+        endpoint.update(items)
+
+  if len(found_hosts) > 1 or args.summary:
+    print_report(report, sum(len(x) for _, x in updates), len(dev_ifaces) + len(vm_ifaces), args.no_change)
 
 
 if __name__ == "__main__":
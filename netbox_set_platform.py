@@ -5,6 +5,7 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -21,7 +22,7 @@ parser.add_argument('-p', '--platform', help='New platform', required=True)
 parser.add_argument('-n', '--dry-run', help='Dry run', action='store_true')
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
 # find device or vm
 vm = nb.virtualization.virtual_machines.get(name=args.fqdn)
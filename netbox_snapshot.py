@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+from sys import stderr,exit,argv
+import os,argparse
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments
+from netbox_tools.snapshot import SCHEMA, write_snapshot
+
+# display error & bail out
+def fail(*messages):
+  print(*messages, file=stderr)
+  exit(1)
+
+def warn(*messages):
+  print(*messages, file=stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Write compact snapshot of NetBox inventory for read-only scripts (see --snapshot)')
+  parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
+  parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
+  parser.add_argument('-o', '--output', help='Snapshot file (defaults to NETBOX_SNAPSHOT env)', default=os.getenv('NETBOX_SNAPSHOT'))
+  parser.add_argument('-e', '--endpoints', help='Endpoints to include (defaults to all)', nargs='+', choices=list(SCHEMA.keys()))
+  add_fetch_arguments(parser)
+  args = parser.parse_args()
+
+  if not args.output:
+    fail("output file must be specified")
+
+  nb = connect(args.api_url, args.token)
+
+  writer = write_snapshot(nb, args.output, args.endpoints, args.threads)
+  for name, table in writer.tables.items():
+    warn(name, table['rows'], "rows")
+  warn(len(writer.strings), "strings,", os.path.getsize(args.output), "bytes written to", args.output)
+
+
+if __name__ == "__main__":
+  main()
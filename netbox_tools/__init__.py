@@ -0,0 +1 @@
+# shared helpers for netbox-tools scripts
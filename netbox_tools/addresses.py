@@ -0,0 +1,21 @@
+# ip addresses of devices and vms grouped by assigned interface
+
+from collections import defaultdict
+from netbox_tools.fetch import chunks
+
+
+# fetch all addresses of device(s) or vm(s) in one call per chunk of ids
+# instead of one ip_addresses.get(interface_id=...) per interface.
+# returns {interface id: [ip, ...]}, interfaces without address are missing.
+def ips_by_interface(inventory, device_id=None, virtual_machine_id=None):
+  if (device_id == None) == (virtual_machine_id == None):
+    raise ValueError("specify either device_id or virtual_machine_id")
+  key, ids = ('device_id', device_id) if device_id != None else ('virtual_machine_id', virtual_machine_id)
+  assigned_type = 'dcim.interface' if key == 'device_id' else 'virtualization.vminterface'
+
+  res = defaultdict(list)
+  for chunk in chunks(ids if isinstance(ids, list) else [ids]):
+    for ip in inventory.filter('ip_addresses', **{key: chunk}):
+      if ip.assigned_object_type == assigned_type:
+        res[ip.assigned_object_id].append(ip)
+  return res
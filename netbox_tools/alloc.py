@@ -0,0 +1,252 @@
+# allocators of unique resources for provisioning scripts. each allocator
+# loads only fields it needs once and answers all candidates from memory.
+
+import ipaddress, random, itertools
+from sys import stderr
+from uuid import uuid4
+from netbox_tools.fetch import fetch_iter, projection
+
+def warn(*messages):
+  print(*messages, file=stderr)
+
+
+# vm uuids (custom field "uuid") in full and short (first segment) form.
+# with server_side=True, every candidate is checked with cf_uuid/cf_uuid__isw
+# query instead of loading all vms.
+class UuidIndex:
+  def __init__(self, nb, server_side=False, threads=None):
+    self.nb = nb
+    self.server_side = server_side
+    self.threads = threads
+    self.uuids = None
+    self.short_uuids = None
+
+  def load(self):
+    if self.uuids != None:
+      return
+    self.uuids = set()
+    self.short_uuids = set()
+    endpoint = self.nb.virtualization.virtual_machines
+    for vm in fetch_iter(endpoint, self.threads, **projection(['name', 'custom_fields'])):
+      uuid = (vm.custom_fields or {}).get('uuid')
+      if not uuid:
+        warn('vm without uuid', vm.name)
+        continue
+      self.add(uuid)
+
+  def add(self, uuid):
+    if self.uuids != None:
+      self.uuids.add(uuid)
+      self.short_uuids.add(uuid.split('-')[0])
+
+  def exists(self, uuid, short=False):
+    if self.server_side:
+      endpoint = self.nb.virtualization.virtual_machines
+      if endpoint.count(cf_uuid=uuid) > 0:
+        return True
+      return short and endpoint.count(cf_uuid__isw=uuid.split('-')[0]) > 0
+    self.load()
+    if uuid in self.uuids:
+      return True
+    return short and uuid.split('-')[0] in self.short_uuids
+
+  # new unique uuid, reserved in index so next call won't return it again
+  def generate(self, short=False, tries=10):
+    for _ in range(tries):
+      uuid = str(uuid4())
+      if not self.exists(uuid, short):
+        self.add(uuid)
+        return uuid
+    return None
+
+
+# lun / drbd resource ids (custom field "storage_id") of vms in cluster.
+# used ids are kept in bitmap, free ids are handed out lowest first.
+# ids are unique per cluster, not per storage device: drbd resources of
+# all vms live on the same cluster nodes, and this is the scope
+# netbox_create_vm.py always allocated and verified luns in.
+class LunAllocator:
+  def __init__(self, nb, cluster_id, first=1, last=499, threads=None):
+    self.nb = nb
+    self.cluster_id = cluster_id
+    self.first = first
+    self.last = last
+    self.threads = threads
+    self.used = None
+    self.next_free = first
+
+  def load(self):
+    if self.used != None:
+      return
+    self.used = bytearray(self.last + 1)
+    endpoint = self.nb.virtualization.virtual_machines
+    for vm in fetch_iter(endpoint, self.threads, cluster_id=self.cluster_id, **projection(['custom_fields'])):
+      self.reserve((vm.custom_fields or {}).get('storage_id'))
+
+  def reserve(self, lun):
+    if self.used != None and isinstance(lun, int) and 0 <= lun <= self.last:
+      self.used[lun] = 1
+
+  # allocate count free luns at once, None if there is not enough of them
+  def allocate(self, count=1):
+    self.load()
+    res = []
+    lun = self.next_free
+    while len(res) < count and lun <= self.last:
+      if not self.used[lun]:
+        res.append(lun)
+      lun += 1
+    if len(res) < count:
+      return None
+    for lun in res:
+      self.used[lun] = 1
+    self.next_free = res[-1] + 1 if res else self.next_free
+    return res
+
+  # vms having lun assigned, from one targeted query
+  def holders(self, lun):
+    return list(self.nb.virtualization.virtual_machines.filter(cluster_id=self.cluster_id, cf_storage_id=lun, **projection(['name', 'custom_fields'])))
+
+
+# addresses from prefix. free addresses are reserved by netbox with one
+# available-ips list POST for any number of them. requested address is
+# checked locally for containment and with one address= lookup.
+class IpAllocator:
+  def __init__(self, nb, prefix):
+    self.nb = nb
+    self.prefix = prefix
+    self.network = ipaddress.ip_network(prefix.prefix)
+
+  # address with prefix length of network
+  def masked(self, address):
+    return "%s/%d" % (ipaddress.ip_interface(address).ip, self.network.prefixlen)
+
+  # reason why address can't be used, None if it is free
+  def check(self, address):
+    try:
+      addr = ipaddress.ip_interface(address)
+    except ValueError as e:
+      return str(e)
+    if addr.ip not in self.network:
+      return "%s is not within %s" % (addr.ip, self.prefix.prefix)
+    if '/' in str(address) and addr.network.prefixlen != self.network.prefixlen:
+      return "%s has different prefix length than %s" % (address, self.prefix.prefix)
+    if self.network.num_addresses > 2 and addr.ip in (self.network.network_address, self.network.broadcast_address):
+      return "%s is network or broadcast address" % addr.ip
+    vrf_id = self.prefix.vrf.id if self.prefix.vrf else 'null'
+    existing = list(self.nb.ipam.ip_addresses.filter(address=str(addr.ip), vrf_id=vrf_id))
+    if existing:
+      return "%s is already used by %s" % (addr.ip, existing[0].assigned_object or existing[0].dns_name or existing[0].id)
+    return None
+
+  # reserve first free addresses, one for each of ip_data items
+  def allocate(self, ip_data):
+    if not ip_data:
+      return []
+    res = self.prefix.available_ips.create(list(ip_data))
+    res = res if isinstance(res, list) else [res]
+    if len(res) != len(ip_data):
+      if res:
+        self.nb.ipam.ip_addresses.delete([x.id for x in res])
+      raise ValueError("allocated %d of %d addresses in %s" % (len(res), len(ip_data), self.prefix.prefix))
+    return res
+
+  # first free addresses without reserving them, for staged creation.
+  # skip holds addresses known to be taken meanwhile.
+  def free(self, count, skip=()):
+    if count <= 0:
+      return []
+    res = []
+    for ip in self.prefix.available_ips.list(limit=count + len(skip)):
+      if ip.address not in skip:
+        res.append(ip.address)
+    return res[:count]
+
+  # create requested addresses in one bulk POST, all must pass check()
+  def reserve(self, ip_data):
+    if not ip_data:
+      return []
+    return self.nb.ipam.ip_addresses.create(list(ip_data))
+
+
+# mac addresses from 52:54:00 oui. used suffixes of vm and device interfaces
+# are loaded once into bitmap of 2^24 bits. random candidates are tried
+# while space is sparse, bitmap is scanned for free bits once it gets dense.
+class MacAllocator:
+  OUI = 0x525400
+  SIZE = 1 << 24
+  RANDOM_TRIES = 16
+
+  def __init__(self, nb, threads=None):
+    self.nb = nb
+    self.threads = threads
+    self.used = None
+    self.count = 0
+
+  def endpoints(self):
+    return [self.nb.virtualization.interfaces, self.nb.dcim.interfaces]
+
+  def load(self):
+    if self.used != None:
+      return
+    self.used = bytearray(self.SIZE // 8)
+    for endpoint in self.endpoints():
+      for iface in fetch_iter(endpoint, self.threads, mac_address__isw='52:54:00', **projection(['mac_address'])):
+        if iface.mac_address:
+          self.reserve(iface.mac_address)
+
+  @staticmethod
+  def parse(mac):
+    return int(mac.replace(':', '').replace('-', ''), 16)
+
+  @staticmethod
+  def format(value):
+    return ':'.join('%02x' % ((value >> x) & 0xff) for x in range(40, -8, -8))
+
+  def is_used(self, mac):
+    value = self.parse(mac)
+    if value >> 24 != self.OUI:
+      # outside of our oui, ask netbox
+      return any(endpoint.count(mac_address=mac) > 0 for endpoint in self.endpoints())
+    self.load()
+    suffix = value & 0xffffff
+    return bool(self.used[suffix >> 3] & (1 << (suffix & 7)))
+
+  def reserve(self, mac):
+    value = self.parse(mac)
+    if value >> 24 != self.OUI or self.used == None:
+      return
+    suffix = value & 0xffffff
+    if not self.used[suffix >> 3] & (1 << (suffix & 7)):
+      self.used[suffix >> 3] |= 1 << (suffix & 7)
+      self.count += 1
+
+  # first free suffix at or after start, wrapping around
+  def scan(self, start):
+    for i in itertools.chain(range(start >> 3, len(self.used)), range(0, start >> 3)):
+      if self.used[i] != 0xff:
+        for bit in range(8):
+          if not self.used[i] & (1 << bit):
+            return (i << 3) | bit
+    return None
+
+  # count of unique unused macs, reserved so they are not handed out again
+  def allocate(self, count=1):
+    self.load()
+    if self.SIZE - self.count < count:
+      return None
+    res = []
+    while len(res) < count:
+      suffix = None
+      if self.count < self.SIZE // 2:
+        for _ in range(self.RANDOM_TRIES):
+          candidate = random.randrange(self.SIZE)
+          if not self.used[candidate >> 3] & (1 << (candidate & 7)):
+            suffix = candidate
+            break
+      if suffix == None:
+        suffix = self.scan(random.randrange(self.SIZE))
+      mac = self.format((self.OUI << 24) | suffix)
+      self.reserve(mac)
+      res.append(mac)
+    return res
@@ -0,0 +1,260 @@
+# local snapshot cache of core netbox endpoints for read-only scripts.
+#
+# each endpoint is stored as json list of raw objects under
+# NETBOX_CACHE_DIR/<netbox host>/<endpoint>.json. within TTL the file is used
+# as is, after that only objects with last_updated >= newest cached object
+# are re-fetched and merged. deleted objects are pruned when object count
+# on server differs from the cached one.
+#
+#   NETBOX_CACHE          - enable cache by default (default False)
+#   NETBOX_CACHE_DIR      - cache directory (default ~/.cache/netbox-tools)
+#   NETBOX_CACHE_TTL      - TTL in seconds for all endpoints
+#   NETBOX_CACHE_TTL_<EP> - TTL for one endpoint, eg. NETBOX_CACHE_TTL_VLANS=3600
+#   NETBOX_SNAPSHOT       - read objects from compact snapshot file instead
+#                           (see snapshot.py), takes precedence over cache
+
+import os,json,time,argparse,ast
+from urllib.parse import urlsplit
+from netbox_tools.fetch import fetch_all, fetch_iter, PROJECTION_PARAMS
+
+ENDPOINTS = {
+  'devices': ('dcim', 'devices'),
+  'virtual_machines': ('virtualization', 'virtual_machines'),
+  'interfaces': ('dcim', 'interfaces'),
+  'vm_interfaces': ('virtualization', 'interfaces'),
+  'ip_addresses': ('ipam', 'ip_addresses'),
+  'prefixes': ('ipam', 'prefixes'),
+  'vlans': ('ipam', 'vlans'),
+  'services': ('ipam', 'services'),
+}
+
+# default TTLs in seconds. addressing plan changes rarely.
+DEFAULT_TTL = {
+  'devices': 300,
+  'virtual_machines': 300,
+  'interfaces': 300,
+  'vm_interfaces': 300,
+  'ip_addresses': 300,
+  'prefixes': 900,
+  'vlans': 900,
+  'services': 300,
+}
+
+# filters on ip addresses pointing to assigned interface
+ASSIGNED_FILTERS = {
+  'interface_id': 'dcim.interface',
+  'vminterface_id': 'virtualization.vminterface',
+}
+
+# filters matching one of list values, eg. services port=22
+LIST_FILTERS = {
+  'port': 'ports',
+}
+
+
+def add_cache_arguments(parser):
+  parser.add_argument('--cache', help='Use local snapshot cache of NetBox objects (defaults to NETBOX_CACHE env or False)', action=argparse.BooleanOptionalAction, default=ast.literal_eval(os.getenv('NETBOX_CACHE', 'False')))
+  parser.add_argument('--snapshot', help='Read NetBox objects from snapshot file written by netbox_snapshot.py (defaults to NETBOX_SNAPSHOT env)', default=os.getenv('NETBOX_SNAPSHOT'))
+
+def endpoint_ttl(name):
+  value = os.getenv('NETBOX_CACHE_TTL_' + name.upper()) or os.getenv('NETBOX_CACHE_TTL')
+  return int(value) if value else DEFAULT_TTL[name]
+
+def get_endpoint(nb, name):
+  app, endpoint = ENDPOINTS[name]
+  return getattr(getattr(nb, app), endpoint)
+
+
+# value of filter key on raw object, eg. "device" or "cluster_id"
+def row_value(row, key):
+  if key in row:
+    return row[key]
+  field, _, attr = key.rpartition('_')
+  # unset nested object, eg. vm without tenant
+  if field in row and row[field] == None:
+    return None
+  if isinstance(row.get(field), dict):
+    return row[field].get(attr)
+  # ip addresses match parent of assigned interface, eg. device_id
+  if 'assigned_object' in row and field in ('device', 'virtual_machine'):
+    return (row['assigned_object'] or {}).get(field, {}).get(attr)
+  raise KeyError(key)
+
+def row_matches(row, key, value):
+  values = value if isinstance(value, list) else [value]
+  if key in ASSIGNED_FILTERS:
+    return row.get('assigned_object_type') == ASSIGNED_FILTERS[key] and row.get('assigned_object_id') in values
+  if key in LIST_FILTERS:
+    return any(x in values for x in row.get(LIST_FILTERS[key]) or [])
+  v = row_value(row, key)
+  # nested objects match by id, name, slug or choice value
+  if isinstance(v, dict):
+    return any(v.get(x) in values for x in ('id', 'name', 'slug', 'value'))
+  return v in values
+
+# can filters be evaluated locally?
+def local_filters(filters):
+  return all('__' not in key and key != 'q' for key in filters)
+
+# local objects are complete, projection parameters only matter for api
+def strip_projection(filters):
+  return {k: v for k, v in filters.items() if k not in PROJECTION_PARAMS}
+
+
+class EndpointCache:
+  def __init__(self, nb, name, path, threads=None):
+    self.nb = nb
+    self.name = name
+    self.path = path
+    self.threads = threads
+    self.endpoint = get_endpoint(nb, name)
+    self.rows = None
+    self.records = {}
+    self.by_name = None
+
+  def load(self):
+    if self.rows != None:
+      return
+    state = None
+    if os.path.exists(self.path):
+      with open(self.path) as f:
+        state = json.load(f)
+
+    if state == None:
+      state = self.fetch_full()
+    elif time.time() - state['fetched'] > endpoint_ttl(self.name):
+      state = self.refresh(state)
+    self.rows = state['rows']
+
+  # full records, no projection. cached rows serve every script, including
+  # config_context of devices and vms used by config and networking renderers.
+  def fetch_full(self):
+    state = {'fetched': time.time()}
+    state['rows'] = [dict(x) for x in fetch_all(self.endpoint, self.threads)]
+    self.save(state)
+    return state
+
+  # fetch only objects changed since the newest cached one. rows keep order
+  # of netbox: changed rows are updated in place and new ones appended, or
+  # rows follow order of id list when it is fetched to find deletions.
+  def refresh(self, state):
+    fetched = time.time()
+    last_updated = max((x.get('last_updated') or '' for x in state['rows']), default='')
+    if not last_updated:
+      return self.fetch_full()
+
+    rows = {x['id']: x for x in state['rows']}
+    for obj in fetch_all(self.endpoint, self.threads, last_updated__gte=last_updated):
+      rows[obj.id] = dict(obj)
+
+    # something got deleted, keep only ids still present on server
+    if len(rows) != self.endpoint.count():
+      ids = [x.id for x in fetch_all(self.endpoint, self.threads, brief=1)]
+      rows = [rows[i] for i in ids if i in rows]
+    else:
+      rows = list(rows.values())
+
+    state = {'fetched': fetched, 'rows': rows}
+    self.save(state)
+    return state
+
+  def save(self, state):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(state, f)
+    os.replace(tmp_path, self.path)
+
+  def record(self, i):
+    if i not in self.records:
+      self.records[i] = self.endpoint.return_obj(self.rows[i], self.nb, self.endpoint)
+    return self.records[i]
+
+  def all(self):
+    self.load()
+    return [self.record(i) for i in range(len(self.rows))]
+
+  def filter(self, **filters):
+    self.load()
+    candidates = range(len(self.rows))
+    # names are indexed, everything else is a scan
+    if 'name' in filters and not isinstance(filters['name'], list):
+      if self.by_name == None:
+        self.by_name = {}
+        for i, row in enumerate(self.rows):
+          self.by_name.setdefault(row.get('name'), []).append(i)
+      candidates = self.by_name.get(filters['name'], [])
+    res = []
+    for i in candidates:
+      if all(row_matches(self.rows[i], k, v) for k, v in filters.items()):
+        res.append(self.record(i))
+    return res
+
+
+# read access to core endpoints, served from snapshot file or local cache
+# when enabled. otherwise all calls go straight to the api.
+class Inventory:
+  def __init__(self, nb, cache=False, cache_dir=None, threads=None, snapshot=None):
+    self.nb = nb
+    self.cache = cache
+    self.threads = threads
+    cache_dir = cache_dir or os.getenv('NETBOX_CACHE_DIR') or os.path.expanduser('~/.cache/netbox-tools')
+    self.cache_dir = os.path.join(cache_dir, urlsplit(nb.base_url).netloc)
+    self.endpoints = {}
+    self.snapshot = None
+    if snapshot:
+      from netbox_tools.snapshot import open_snapshot
+      self.snapshot = open_snapshot(nb, snapshot)
+
+  def endpoint_cache(self, name):
+    if name not in self.endpoints:
+      self.endpoints[name] = EndpointCache(self.nb, name, os.path.join(self.cache_dir, name + '.json'), self.threads)
+    return self.endpoints[name]
+
+  def all(self, endpoint):
+    if self.snapshot and endpoint in self.snapshot.meta['tables']:
+      from netbox_tools.snapshot import RecordView
+      table = self.snapshot.table(endpoint)
+      return RecordView(table, range(table.rows))
+    if not self.cache:
+      return fetch_all(get_endpoint(self.nb, endpoint), self.threads)
+    return self.endpoint_cache(endpoint).all()
+
+  # filters not understood locally are passed to the api, together with
+  # projection parameters (see fetch.projection())
+  def filter(self, endpoint, **filters):
+    local = strip_projection(filters)
+    if self.snapshot and endpoint in self.snapshot.meta['tables'] and local_filters(local):
+      from netbox_tools.snapshot import RecordView
+      table = self.snapshot.table(endpoint)
+      try:
+        return RecordView(table, table.find(**local))
+      except KeyError:
+        pass
+    if self.cache and local_filters(local):
+      try:
+        return self.endpoint_cache(endpoint).filter(**local)
+      except KeyError:
+        pass
+    return list(get_endpoint(self.nb, endpoint).filter(**filters))
+
+  # like filter(), but objects from api are yielded page by page as they
+  # arrive, so output can start before the last page is fetched
+  def iter(self, endpoint, **filters):
+    local = (self.snapshot and endpoint in self.snapshot.meta['tables']) or self.cache
+    if local and local_filters(strip_projection(filters)):
+      return iter(self.filter(endpoint, **filters))
+    return fetch_iter(get_endpoint(self.nb, endpoint), self.threads, **filters)
+
+  # same semantics as pynetbox get(), raises ValueError on multiple results
+  def get(self, endpoint, **filters):
+    if not (self.cache or self.snapshot) or not local_filters(strip_projection(filters)):
+      return get_endpoint(self.nb, endpoint).get(**filters)
+    res = self.filter(endpoint, **filters)
+    if len(res) > 1:
+      raise ValueError("get() returned more than one result.")
+    return res[0] if res else None
+
+
+def inventory_from_args(nb, args):
+  return Inventory(nb, args.cache, threads=getattr(args, 'threads', None), snapshot=getattr(args, 'snapshot', None))
@@ -0,0 +1,98 @@
+# netbox api client shared by all scripts.
+#
+# one pooled requests session per process with retries on 429/5xx, gzip
+# and default page size for list queries. defaults are taken from env:
+#   NETBOX_PAGE_SIZE   - max page size of list queries (default 1000, same as
+#                        netbox's default MAX_PAGE_SIZE, so only lower values
+#                        or servers with raised MAX_PAGE_SIZE make difference)
+#   NETBOX_RETRIES     - retries on connection errors, 429 and 5xx (default 3)
+#   NETBOX_BACKOFF     - retry backoff factor in seconds (default 0.5)
+#   NETBOX_POOL_SIZE   - max open connections (default 16)
+#   NETBOX_TIMEOUT     - request timeout in seconds (default none)
+#   NETBOX_PROXY       - proxy url, eg. socks5h://127.0.0.1:8000 (defaults to
+#                        https_proxy env, which is honored by requests as well)
+
+import os,re,pynetbox,requests
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# detail routes returning plain lists, limit there is number of results
+UNPAGED_ROUTES = re.compile(r'/available-(ips|prefixes|vlans|asns)/?$')
+
+
+def env_int(name, default):
+  value = os.getenv(name)
+  return int(value) if value else default
+
+def env_float(name, default):
+  value = os.getenv(name)
+  return float(value) if value else default
+
+
+class NetboxSession(requests.Session):
+  def __init__(self, page_size=None, timeout=None):
+    super().__init__()
+    self.page_size = page_size
+    self.timeout = timeout
+
+  # limit of one page, missing or 0 (server's MAX_PAGE_SIZE) means page size
+  def clamp(self, limit):
+    limit = int(limit or 0)
+    return self.page_size if limit <= 0 or limit > self.page_size else limit
+
+  def request(self, method, url, params=None, **kwargs):
+    # pynetbox 7 sends limit=0 on list queries and limit=<count> for the
+    # rest after first page, "next" urls carry limit in query string.
+    # clamp all of them to page size, smaller limits (eg. count()) are kept.
+    if self.page_size and method.upper() == 'GET' and not UNPAGED_ROUTES.search(urlsplit(url).path):
+      parts = urlsplit(url)
+      query = parse_qsl(parts.query, keep_blank_values=True)
+      if any(k == 'limit' for k, v in query):
+        query = [(k, self.clamp(v) if k == 'limit' else v) for k, v in query]
+        url = urlunsplit(parts._replace(query=urlencode(query)))
+      else:
+        params = dict(params or {})
+        params['limit'] = self.clamp(params.get('limit'))
+    if self.timeout:
+      kwargs.setdefault('timeout', self.timeout)
+    return super().request(method, url, params=params, **kwargs)
+
+
+def create_session(page_size=None, retries=None, backoff=None, pool_size=None, timeout=None, proxy=None):
+  page_size = page_size if page_size != None else env_int('NETBOX_PAGE_SIZE', 1000)
+  retries = retries if retries != None else env_int('NETBOX_RETRIES', 3)
+  backoff = backoff if backoff != None else env_float('NETBOX_BACKOFF', 0.5)
+  pool_size = pool_size if pool_size != None else env_int('NETBOX_POOL_SIZE', 16)
+  timeout = timeout if timeout != None else env_float('NETBOX_TIMEOUT', None)
+  proxy = proxy if proxy != None else os.getenv('NETBOX_PROXY')
+
+  session = NetboxSession(page_size, timeout)
+  session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+  # retry only idempotent methods, a retried POST could create duplicates
+  retry = Retry(
+    total=retries,
+    backoff_factor=backoff,
+    status_forcelist=RETRY_STATUSES,
+    allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+    respect_retry_after_header=True,
+    raise_on_status=False,
+  )
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+
+  if proxy:
+    session.proxies = {'http': proxy, 'https': proxy}
+
+  return session
+
+
+# drop-in replacement for pynetbox.api(url, token)
+def connect(api_url, token, **kwargs):
+  nb = pynetbox.api(api_url, token=token)
+  nb.http_session = create_session(**kwargs)
+  return nb
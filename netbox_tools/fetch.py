@@ -0,0 +1,103 @@
+# list fetching helpers shared by scripts
+#
+# NETBOX_FETCH_THREADS - number of pages fetched concurrently (default 8)
+#
+# projection() builds query parameters asking netbox for only some
+# attributes. `fields` is honored by netbox >= 4.0, older versions ignore it
+# and still drop rendered config_context with `exclude`.
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def default_threads():
+  return int(os.getenv('NETBOX_FETCH_THREADS') or 8)
+
+def add_fetch_arguments(parser):
+  parser.add_argument('-j', '--threads', help='Fetch pages of large lists concurrently using N threads (defaults to NETBOX_FETCH_THREADS env or 8, 1 disables)', type=int, default=default_threads())
+
+
+# query parameters of read paths, not filters
+PROJECTION_PARAMS = ('fields', 'brief', 'exclude', 'omit')
+
+# fields are top level attributes or dotted paths (eg. "custom_fields.uuid"),
+# id is always included. config_context is excluded unless asked for.
+def projection(fields=None, brief=False):
+  if brief:
+    return {'brief': 1}
+  names = ['id']
+  for field in fields or []:
+    name = field.split('.')[0]
+    if name not in names:
+      names.append(name)
+  res = {}
+  if 'config_context' not in names:
+    res['exclude'] = 'config_context'
+  if fields:
+    res['fields'] = ','.join(names)
+  return res
+
+
+def fetch_page(endpoint, page_size, offset, filters):
+  return list(endpoint.filter(limit=page_size, offset=offset, **filters))
+
+
+# iterate over all objects matching filters, in netbox order.
+# count is read from the first page and remaining pages are fetched by
+# offset in a bounded thread pool, at most `threads` pages ahead.
+#
+# pynetbox.api(..., threading=True) pages concurrently as well, but with
+# fixed pool of 4 threads, it yields nothing before every page arrived and
+# appends pages in completion order. here pages are yielded in netbox order
+# as soon as they are fetched (streaming output, see output.py), memory is
+# bounded by look-ahead and thread count is per call (-j).
+def fetch_iter(endpoint, threads=None, page_size=None, **filters):
+  threads = threads if threads != None else default_threads()
+  if threads <= 1:
+    yield from endpoint.filter(**filters)
+    return
+
+  page_size = page_size or getattr(endpoint.api.http_session, 'page_size', None) or 1000
+  first = endpoint.filter(limit=page_size, offset=0, **filters)
+  results = list(first)
+  count = first.request.count
+  yield from results
+
+  # server may cap page size with MAX_PAGE_SIZE
+  if len(results) < page_size and len(results) < count:
+    page_size = len(results)
+  if page_size == 0 or len(results) >= count:
+    return
+
+  offsets = iter(range(page_size, count, page_size))
+  with ThreadPoolExecutor(max_workers=threads) as pool:
+    pending = deque()
+    for offset in offsets:
+      pending.append(pool.submit(fetch_page, endpoint, page_size, offset, filters))
+      if len(pending) >= threads:
+        break
+    while pending:
+      page = pending.popleft().result()
+      offset = next(offsets, None)
+      if offset != None:
+        pending.append(pool.submit(fetch_page, endpoint, page_size, offset, filters))
+      yield from page
+
+def fetch_all(endpoint, threads=None, page_size=None, **filters):
+  return list(fetch_iter(endpoint, threads, page_size, **filters))
+
+
+# split list of ids passed in query string, keeps urls reasonably short
+def chunks(items, size=100):
+  items = list(items)
+  for i in range(0, len(items), size):
+    yield items[i:i+size]
+
+# fetch objects by id in batched list calls instead of one get() per object.
+# filters may hold projection parameters.
+def fetch_by_ids(endpoint, ids, chunk_size=100, **filters):
+  res = []
+  for ids in chunks(sorted(set(ids)), chunk_size):
+    res.extend(endpoint.filter(id=ids, **filters))
+  return res
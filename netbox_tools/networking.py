@@ -0,0 +1,174 @@
+# networking configuration of device or vm, as consumed by
+# ansible-roles-common/linux-networking
+
+import re, ipaddress, yaml
+from sys import stderr
+from collections import defaultdict
+from netbox_tools.fetch import chunks
+from netbox_tools.addresses import ips_by_interface
+
+HEADER = "# generated from netbox. do not change manually\n"
+
+
+class NetworkingError(Exception):
+  pass
+
+def assume_ip_gateway(network):
+  return str(ipaddress.ip_network(network,False)[1]).split('/')[0]
+
+def debug(*msg):
+  return
+  print(*msg, file=stderr)
+
+def warn(*msg):
+  print(*msg, file=stderr)
+
+
+# interfaces of devices and vms, keyed by device/vm id
+def fetch_interfaces(inventory, devs, vms):
+  res = defaultdict(list)
+  for ids in chunks(x.id for x in devs):
+    for iface in inventory.filter('interfaces', device_id=ids):
+      res[('dev', iface.device.id)].append(iface)
+  for ids in chunks(x.id for x in vms):
+    for iface in inventory.filter('vm_interfaces', virtual_machine_id=ids):
+      res[('vm', iface.virtual_machine.id)].append(iface)
+  return res
+
+# build networking config of single device or vm
+def render_networking(obj, ifaces, addresses, vm=False):
+  dev = not vm
+  primary_addr = None
+  config_context = obj['config_context']
+  if not obj.primary_ip:
+    if vm:
+      raise NetworkingError('!! virtual machine without primary ip', obj, dict(obj))
+    raise NetworkingError('!! device without primary ip', obj)
+  primary_addr = obj['primary_ip']['address']
+
+  res = { 'networking': {} }
+  if config_context and 'networking' in config_context:
+    res['networking'] = config_context['networking']
+
+  lag_ifaces = defaultdict(list)
+  blacklist = []
+
+  for iface in ifaces:
+    # ignore interfaces based on device and interface types as well as names
+
+    # ignore...
+    # - tun, tap and wg interfaces
+    # - disabled interfaces
+    if re.match(r'^(tun|tap|wg)', iface.name) or not iface.enabled:
+      blacklist.append(iface.name)
+      continue
+
+    # on physical devices, ignore...
+    if dev:
+      # - management interfaces
+      # - all FC interfaces
+      if iface.mgmt_only or re.match(r'.*fc\-.*',iface.type.value):
+        blacklist.append(iface.name)
+        continue
+
+    if iface.name not in res['networking']:
+      res['networking'][iface.name] = {}
+
+  # find all lag parent and children interfaces
+  if dev:
+    for iface in ifaces:
+      if not iface.lag:
+        continue
+      lag_ifaces[iface.lag.name].append(iface.name)
+      debug("blacklist.append", iface.name)
+      blacklist.append(iface.name)
+    for lag_parent, lag_children in lag_ifaces.items():
+      res['networking'][lag_parent]['bond_slaves'] = lag_children
+      for lag_child in lag_children:
+        res['networking'][lag_child]['bond_master'] = lag_parent
+
+  for iface in ifaces:
+    # mac address of interface
+    if iface.mac_address and iface.name in res['networking']:
+      res['networking'][iface.name]['ether'] = iface.mac_address.lower()
+
+    # if we encounter tagged LACP interface, assume device is hypervisor or cluster node.
+    # create vlan interfaces and associated bridge interfaces.
+    if iface.mode and iface.mode.value == 'tagged' and not iface.lag:
+      for vlan in iface.tagged_vlans:
+        if 'vlan%d' % vlan.vid not in res['networking']:
+          res['networking']['vlan%d' % vlan.vid] = {}
+        res['networking']['vlan%d' % vlan.vid]['vlan-iface'] = iface.name
+        res['networking']['vlan%d' % vlan.vid]['vlan-id'] = vlan.vid
+
+        if 'brVlan%d' % vlan.vid not in res['networking']:
+          res['networking']['brVlan%d' % vlan.vid] = {}
+        res['networking']['brVlan%d' % vlan.vid]['bridge_ports'] = [ 'vlan%d' % vlan.vid ]
+
+    # rest is for non-lag interfaces
+    if iface.name in blacklist:
+      debug("blacklist iface", iface.name)
+      continue
+
+    # non-default mtu?
+    if iface.mtu:
+      res['networking'][iface.name]['mtu'] = iface.mtu
+
+    # ip address, if interface has one. more addresses are listed.
+    ips = addresses.get(iface.id, [])
+    if len(ips) == 1:
+      res['networking'][iface.name]['address'] = ips[0].address
+    elif ips:
+      res['networking'][iface.name]['address'] = [ip.address for ip in ips]
+    if ips:
+      #XXX: since there is not "gateway" role function, guess default gateway
+      # for interface with primary address, if not defined already
+      if 'gateway' in res['networking'][iface.name]:
+        warn(obj.name, iface.name, "already has gateway defined")
+      elif primary_addr in [ip.address for ip in ips]:
+        gateway_addr = assume_ip_gateway(primary_addr)
+        res['networking'][iface.name]['gateway'] = gateway_addr
+    if iface.custom_fields.get('routes_list', None):
+      if not iface.custom_fields['routes_via']:
+        raise NetworkingError("missing next-hop")
+      routes = []
+      for route in iface.custom_fields['routes_list']:
+        routes.append({
+          "net": route['prefix'],
+          "via": iface.custom_fields['routes_via']['address'].split('/')[0],
+          })
+      res['networking'][iface.name]['routes'] = routes
+
+    # for vm, generate matching 'virtual_host_iface'
+    if vm:
+      if iface.untagged_vlan:
+        res['networking'][iface.name]['virtual_host_iface'] = 'brVlan%d' % iface.untagged_vlan.vid
+
+  # make sure vm is in planned, staging or active phase
+  if str(obj.status) not in ['Planned','Staged','Active']:
+    raise NetworkingError(obj.name, 'is in invalid state', obj.status)
+
+  return res
+
+# file content, same as printed by single host mode
+def dump_networking(res):
+  return HEADER + yaml.dump(res) + "\n"
+
+
+# render networking of all devices and vms. yields (obj, res, error) with
+# interfaces and addresses fetched in batches for the whole set, unless
+# interfaces were already fetched by caller.
+def render_all(inventory, devs, vms, ifaces=None):
+  if ifaces == None:
+    ifaces = fetch_interfaces(inventory, devs, vms)
+  addresses = {
+    'dev': ips_by_interface(inventory, device_id=[x.id for x in devs]) if devs else {},
+    'vm': ips_by_interface(inventory, virtual_machine_id=[x.id for x in vms]) if vms else {},
+  }
+  for kind, objs in (('dev', devs), ('vm', vms)):
+    for obj in objs:
+      try:
+        res = render_networking(obj, ifaces.get((kind, obj.id), []), addresses[kind], vm=kind == 'vm')
+        yield obj, res, None
+      except NetworkingError as e:
+        yield obj, None, e
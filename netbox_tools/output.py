@@ -0,0 +1,83 @@
+# streaming output of objects as text, json, csv or ndjson.
+#
+# fields are dotted paths into objects, eg. "custom_fields.uuid" or
+# "primary_ip4.address". rows are written as soon as objects arrive, so
+# consumers like `| head` or `| xargs -P` can start before the last page.
+
+import os,sys,json,csv
+from pynetbox.core.response import Record
+
+FORMATS = ('text', 'json', 'csv', 'ndjson')
+
+
+def add_format_arguments(parser, default_fields):
+  parser.add_argument('-f', '--format', help='Output format (defaults to text)', choices=FORMATS, default='text')
+  parser.add_argument('-F', '--fields', help='Comma separated fields to output, eg. "name,custom_fields.uuid,primary_ip4.address" (defaults to "%s")' % ','.join(default_fields))
+
+def field_list(args, default_fields):
+  if not args.fields:
+    return list(default_fields)
+  return [x.strip() for x in args.fields.split(',') if x.strip()]
+
+
+# json compatible value, choices are reduced to their value
+def plain(value):
+  if isinstance(value, Record):
+    value = dict(value)
+  if isinstance(value, dict):
+    if 'value' in value and 'label' in value:
+      return value['value']
+    return {k: plain(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [plain(x) for x in value]
+  return value
+
+def field_value(obj, path):
+  for part in path.split('.'):
+    if obj == None:
+      return None
+    obj = obj.get(part) if isinstance(obj, dict) else getattr(obj, part, None)
+  return plain(obj)
+
+def text_value(value):
+  if value == None:
+    return ''
+  if isinstance(value, (dict, list)):
+    return json.dumps(value)
+  return str(value)
+
+
+# write objects one by one. text format prints space separated fields, or
+# line returned by `text` callable when given. fields are read from dict of
+# record, so field missing from projection (or unknown one) is empty instead
+# of lazy full_details() request per record.
+def write_objects(objs, fmt, fields, text=None, out=None):
+  out = out or sys.stdout
+  # flush each line even when piped
+  if hasattr(out, 'reconfigure'):
+    out.reconfigure(line_buffering=True)
+  try:
+    if fmt == 'csv':
+      writer = csv.writer(out)
+      writer.writerow(fields)
+    first = True
+    for obj in objs:
+      values = dict(obj) if isinstance(obj, Record) else obj
+      if fmt == 'text':
+        line = text(obj) if text else ' '.join(text_value(field_value(values, x)) for x in fields)
+        print(line, file=out)
+        continue
+      row = {x: field_value(values, x) for x in fields}
+      if fmt == 'csv':
+        writer.writerow([text_value(row[x]) for x in fields])
+      elif fmt == 'ndjson':
+        print(json.dumps(row), file=out)
+      elif fmt == 'json':
+        print('[' if first else ',', json.dumps(row), file=out)
+      first = False
+    if fmt == 'json':
+      print('[]' if first else ']', file=out)
+  except BrokenPipeError:
+    # consumer went away, eg. `| head`. don't fail on final flush.
+    os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+    sys.exit(0)
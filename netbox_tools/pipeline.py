@@ -0,0 +1,73 @@
+# concurrent execution of independent api requests
+#
+# parallel() runs independent lookups at once, TaskGraph runs dependent
+# steps (eg. create vm, then its interface) as soon as their dependencies
+# are done, so requests which don't depend on each other overlap.
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from netbox_tools.fetch import default_threads
+
+
+class TaskError(Exception):
+  def __init__(self, name, error):
+    super().__init__(name, error)
+    self.name = name
+    self.error = error
+
+
+# run {name: callable} concurrently, returns {name: result}.
+# first failure (in order of tasks) is raised after all calls finished.
+def parallel(tasks, threads=None):
+  threads = threads or default_threads()
+  with ThreadPoolExecutor(max_workers=max(1, min(threads, len(tasks)))) as pool:
+    futures = {name: pool.submit(fn) for name, fn in tasks.items()}
+  return {name: future.result() for name, future in futures.items()}
+
+
+# threads for each of n fetches run by parallel(), so that all of them
+# together keep at most `threads` requests in flight (and connections of
+# pool, NETBOX_POOL_SIZE) instead of n * threads
+def split_threads(threads, n):
+  threads = threads or default_threads()
+  return max(1, threads // max(1, n))
+
+
+# steps with dependencies. every step gets dict of results of all steps
+# finished so far. after a failure no new step is started, running steps
+# are waited for and TaskError is raised, so caller sees complete results
+# (eg. for rollback).
+class TaskGraph:
+  def __init__(self, threads=None):
+    self.threads = threads or default_threads()
+    self.tasks = {}
+    self.results = {}
+
+  def add(self, name, fn, deps=()):
+    for dep in deps:
+      if dep not in self.tasks:
+        raise ValueError("unknown dependency %s of %s" % (dep, name))
+    self.tasks[name] = (fn, list(deps))
+
+  def run(self):
+    pending = dict(self.tasks)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=self.threads) as pool:
+      while pending or running:
+        if not error:
+          for name, (fn, deps) in list(pending.items()):
+            if all(dep in self.results for dep in deps):
+              running[pool.submit(fn, dict(self.results))] = name
+              del pending[name]
+        if not running:
+          break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          try:
+            self.results[name] = future.result()
+          except Exception as e:
+            error = error or TaskError(name, e)
+    if error:
+      raise error
+    return self.results
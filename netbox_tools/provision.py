@@ -0,0 +1,636 @@
+# batch provisioning of vms from manifest, used by netbox_create_vm.py -M
+#
+# manifest is yaml list of vms (or {"vms": [...]}) or csv with header. keys
+# are long option names of netbox_create_vm.py, eg. name, ram_size,
+# disk_size, vlan_id, storage_device (space separated in csv). options given
+# on command line are used as defaults for every vm.
+#
+# shared objects (tenant, site, cluster, prefix, ...) are looked up once,
+# uuids, macs, luns and ips are allocated for whole batch in memory and
+# objects are created with bulk POST/PATCH requests.
+
+import re, csv, ipaddress, yaml, pynetbox
+from sys import stderr
+from urllib.parse import urlsplit
+from netbox_tools.fetch import chunks, projection
+from netbox_tools.pipeline import parallel
+from netbox_tools.alloc import UuidIndex, LunAllocator, IpAllocator, MacAllocator
+
+# manifest keys and their types
+MANIFEST_FIELDS = {
+  'name': str, 'fqdn': str, 'tenant': str, 'site': str, 'cluster': str,
+  'ram_size': int, 'cpus': int, 'disk_size': int,
+  'storage_type': str, 'storage_device': list, 'storage_pool': str, 'storage_fixed_lun': int,
+  'vlan_id': int, 'platform': str, 'mac_addr': str, 'ip_addr': str, 'uuid': str,
+}
+
+# never taken from command line defaults, unique for every vm
+UNIQUE_FIELDS = ['name', 'fqdn', 'mac_addr', 'ip_addr', 'uuid', 'storage_fixed_lun']
+
+STORAGE_ROLES = ['Storage', 'Cluster Node', 'Hypervisor']
+
+
+class ProvisionError(Exception):
+  pass
+
+def warn(*messages):
+  print(*messages, file=stderr)
+
+def debug(*messages):
+  print(*messages, file=stderr)
+
+def assume_ip_gateway(network):
+  return str(ipaddress.ip_network(network)[1]).split('/')[0]
+
+
+
+def parse_value(key, value):
+  if value == None or value == '':
+    return None
+  kind = MANIFEST_FIELDS[key]
+  if kind == list:
+    return value if isinstance(value, list) else re.split(r'[\s,]+', str(value).strip())
+  return kind(value)
+
+# list of vm specs, manifest values override defaults
+def load_manifest(path, defaults):
+  with open(path) as f:
+    if path.endswith('.csv'):
+      entries = list(csv.DictReader(f))
+    else:
+      entries = yaml.safe_load(f)
+  if isinstance(entries, dict):
+    entries = entries.get('vms')
+  if not isinstance(entries, list):
+    raise ProvisionError(path, 'manifest must contain list of vms')
+
+  specs = []
+  for entry in entries:
+    spec = {k: None if k in UNIQUE_FIELDS else defaults.get(k) for k in MANIFEST_FIELDS}
+    for key, value in entry.items():
+      key = key.strip().replace('-', '_')
+      if key not in MANIFEST_FIELDS:
+        raise ProvisionError(path, 'unknown manifest key', key)
+      value = parse_value(key, value)
+      if value != None:
+        spec[key] = value
+    specs.append(spec)
+  return specs
+
+# spec of single vm given by command line options
+def spec_from_args(args):
+  return {k: args.get(k) for k in MANIFEST_FIELDS}
+
+# same checks as single vm mode, returns fqdn of vm
+def check_spec(spec):
+  name = spec['name']
+  for key in ('name', 'ram_size', 'disk_size', 'vlan_id', 'storage_device'):
+    if spec[key] == None:
+      raise ProvisionError(name, 'missing', key)
+  if spec['ram_size'] <= 50:
+    raise ProvisionError(name, "Too little ram?")
+  if spec['disk_size'] <= 1:
+    raise ProvisionError(name, "Too little disk space?")
+  if not spec['vlan_id'] in range (2, 4094 +1):
+    raise ProvisionError(name, "VLAN-ID should be between 2 and 4094")
+  if not spec['cpus'] in range(1, 40):
+    raise ProvisionError(name, "How many CPU cores??")
+  for key in ('tenant', 'site', 'cluster'):
+    if spec[key] == None:
+      raise ProvisionError(name, "invalid", key)
+  if spec['storage_type'] not in ('multipath', 'lvm', 'drbd'):
+    raise ProvisionError(name, "invalid storage type", spec['storage_type'])
+  if spec['storage_type'] == 'drbd':
+    if len(spec['storage_device']) != 2:
+      raise ProvisionError(name, 'drbd storage type requires exactly two storage devices specified')
+  elif len(spec['storage_device']) != 1:
+    raise ProvisionError(name, 'exactly one storage device is required')
+  if spec['mac_addr'] and not re.match(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$', spec['mac_addr']):
+    raise ProvisionError(name, "invalid mac address specified")
+
+  if '.' in name:
+    return name
+  if not spec['fqdn']:
+    raise ProvisionError(name, 'name must be fqdn or fqdn must be specified as well')
+  if '.' not in spec['fqdn']:
+    raise ProvisionError(name, 'invalid fqdn specified')
+  return spec['fqdn']
+
+
+# delete objects with one bulk request per endpoint, keeping order of endpoints
+def rollback_objects(nb, objects):
+  groups = []
+  for x in objects:
+    path = urlsplit(x.url).path.rstrip('/').split('/')
+    endpoint = getattr(getattr(nb, path[-3]), path[-2].replace('-', '_'))
+    if groups and groups[-1][0].url == endpoint.url:
+      groups[-1][1].append(x)
+    else:
+      groups.append((endpoint, [x]))
+  for endpoint, objs in groups:
+    try:
+      endpoint.delete(objs)
+    except Exception as e:
+      warn("!! bulk rollback failed, deleting one by one", e)
+      for x in objs:
+        try:
+          x.delete()
+        except Exception as e:
+          warn("!! failed to rollback", x)
+
+
+# memoized lookups of objects shared by vms in batch
+class References:
+  def __init__(self, nb):
+    self.nb = nb
+    self.cache = {}
+
+  def lookup(self, kind, key, endpoint, **filters):
+    if (kind, key) not in self.cache:
+      self.cache[(kind, key)] = endpoint.get(**filters)
+    return self.cache[(kind, key)]
+
+  def tenant(self, slug):
+    return self.lookup('tenant', slug, self.nb.tenancy.tenants, slug=slug)
+
+  def site(self, slug):
+    return self.lookup('site', slug, self.nb.dcim.sites, slug=slug)
+
+  def platform(self, slug):
+    return self.lookup('platform', slug, self.nb.dcim.platforms, slug=slug)
+
+  def cluster(self, name):
+    return self.lookup('cluster', name, self.nb.virtualization.clusters, name=name)
+
+  def prefix(self, vid):
+    return self.lookup('prefix', vid, self.nb.ipam.prefixes, vlan_vid=vid)
+
+  def device(self, name):
+    return self.lookup('device', name, self.nb.dcim.devices, name=name)
+
+  # look up all objects needed by specs concurrently
+  def prefetch(self, specs, threads=None):
+    tasks = {}
+    for spec in specs:
+      keys = [(kind, spec[kind]) for kind in ('tenant', 'site', 'platform', 'cluster')]
+      keys += [('prefix', spec['vlan_id'])] + [('device', x) for x in spec['storage_device'] or []]
+      for kind, key in keys:
+        if (kind, key) not in self.cache and key != None:
+          tasks[(kind, key)] = lambda kind=kind, key=key: getattr(self, kind)(key)
+    parallel(tasks, threads)
+
+
+class Batch:
+  def __init__(self, nb, specs, rollback_list, short_uuids=False, uuid_lookup='index', per_vm_rollback=False, threads=None, transactional=False, retries=3):
+    self.nb = nb
+    self.specs = specs
+    self.rollback_list = rollback_list
+    self.short_uuids = short_uuids
+    self.per_vm_rollback = per_vm_rollback
+    self.threads = threads
+    self.refs = References(nb)
+    self.uuids = UuidIndex(nb, uuid_lookup == 'server', threads)
+    self.macs = MacAllocator(nb, threads)
+    self.luns = {}
+    self.retries = retries
+    self.transactional = transactional
+    self.ip_skip = {}
+    self.vms = []
+    self.failed = []
+
+  # vm failed after objects were created. depending on rollback scope drop
+  # just this vm, or fail whole batch
+  def vm_failed(self, vm, *messages):
+    if not self.per_vm_rollback:
+      raise ProvisionError(vm['name'], *messages)
+    warn(vm['name'], *messages, "- rolling back vm")
+    rollback_objects(self.nb, [x for x in (vm.get('ip'), vm.get('iface'), vm.get('vm')) if x])
+    self.vms.remove(vm)
+    self.failed.append(vm['name'])
+    self.sync_rollback()
+
+  # same order as single vm mode: addresses, interfaces, vms
+  def sync_rollback(self):
+    self.rollback_list[:] = [vm[x] for x in ('ip', 'iface', 'vm') for vm in self.vms if vm.get(x)]
+
+  def resolve(self):
+    names = [x['name'] for x in self.specs]
+    duplicates = set(x for x in names if names.count(x) > 1)
+    if duplicates:
+      raise ProvisionError('duplicit vm names in manifest', *sorted(duplicates))
+
+    for spec in self.specs:
+      check_spec(spec)
+    self.refs.prefetch(self.specs, self.threads)
+
+    for spec in self.specs:
+      vm = {'spec': spec, 'name': spec['name'], 'fqdn': check_spec(spec)}
+      for kind in ('tenant', 'site', 'platform', 'cluster'):
+        vm[kind] = getattr(self.refs, kind)(spec[kind])
+        if not vm[kind]:
+          raise ProvisionError(spec['name'], "no such", kind, spec[kind])
+      vm['net'] = self.refs.prefix(spec['vlan_id'])
+      if not vm['net']:
+        raise ProvisionError(spec['name'], "no such vlan", spec['vlan_id'])
+
+      vm['storage_devices'] = []
+      for storage_name in spec['storage_device']:
+        storage_dev = self.refs.device(storage_name)
+        if not storage_dev:
+          raise ProvisionError(spec['name'], "no such storage device", storage_name)
+        if storage_dev.role.name not in STORAGE_ROLES:
+          raise ProvisionError(spec['name'], "non-storage storage device specified", storage_name)
+        pools = storage_dev.custom_fields['storage_valid_pools']
+        if not pools:
+          raise ProvisionError(spec['name'], "no storage pools defined for storage", storage_dev)
+        if spec['storage_pool'] not in pools:
+          raise ProvisionError(spec['name'], "storage pool", spec['storage_pool'], "is not valid for", storage_dev, "valid are", pools)
+        vm['storage_devices'].append(storage_dev)
+      self.vms.append(vm)
+
+    # make sure none of vms already exists
+    for chunk in chunks(names):
+      existing = list(self.nb.virtualization.virtual_machines.filter(name=chunk, **projection(['name'])))
+      if existing:
+        raise ProvisionError("VMs with specified names already exist", *[x.name for x in existing])
+
+  def allocate_uuids(self):
+    for vm in self.vms:
+      uuid = vm['spec']['uuid']
+      if uuid:
+        if self.uuids.exists(uuid, self.short_uuids):
+          raise ProvisionError(vm['name'], "uuid specified is not unique")
+        self.uuids.add(uuid)
+      else:
+        uuid = self.uuids.generate(self.short_uuids)
+        if not uuid:
+          raise ProvisionError(vm['name'], "faield to generate unique uuid")
+      vm['uuid'] = uuid
+
+  def allocate_macs(self):
+    macs = self.macs
+    requested = [vm['spec']['mac_addr'].lower() for vm in self.vms if vm['spec']['mac_addr']]
+    if len(set(requested)) != len(requested):
+      raise ProvisionError("same mac address requested for more vms")
+    for vm in self.vms:
+      mac = vm['spec']['mac_addr']
+      if mac:
+        if macs.is_used(mac):
+          raise ProvisionError(vm['name'], "interface with same mac address already exists")
+        macs.reserve(mac)
+        vm['mac'] = mac
+
+    generated = macs.allocate(len([vm for vm in self.vms if 'mac' not in vm]))
+    if generated == None:
+      raise ProvisionError("no free mac addresses left")
+    for vm, mac in zip([vm for vm in self.vms if 'mac' not in vm], generated):
+      vm['mac'] = mac
+
+  def allocate_luns(self):
+    allocators = self.luns
+    auto = [vm for vm in self.vms if not vm['spec']['storage_fixed_lun']]
+    fixed = {}
+    for vm in self.vms:
+      if vm['spec']['storage_fixed_lun']:
+        vm['lun'] = vm['spec']['storage_fixed_lun']
+        key = (vm['cluster'].id, vm['lun'])
+        if key in fixed:
+          raise ProvisionError(vm['name'], "lun", vm['lun'], "is requested by", fixed[key], "as well")
+        fixed[key] = vm['name']
+    for cluster_id in set(vm['cluster'].id for vm in auto):
+      if cluster_id not in allocators:
+        allocators[cluster_id] = LunAllocator(self.nb, cluster_id, threads=self.threads)
+      # fixed luns of batch are taken as well
+      allocators[cluster_id].load()
+      for fixed_cluster_id, lun in fixed:
+        if fixed_cluster_id == cluster_id:
+          allocators[cluster_id].reserve(lun)
+      cluster_vms = [vm for vm in auto if vm['cluster'].id == cluster_id]
+      luns = allocators[cluster_id].allocate(len(cluster_vms))
+      if not luns:
+        raise ProvisionError('failed to assign', len(cluster_vms), 'luns in cluster', cluster_vms[0]['cluster'])
+      for vm, lun in zip(cluster_vms, luns):
+        vm['lun'] = lun
+
+  # requested addresses in one bulk POST, rest from available-ips of each
+  # prefix with one list POST per prefix
+  def allocate_ips(self):
+    allocators = {}
+    for vm in self.vms:
+      if vm['net'].id not in allocators:
+        allocators[vm['net'].id] = IpAllocator(self.nb, vm['net'])
+
+    requested = [vm for vm in self.vms if vm['spec']['ip_addr']]
+    addresses = [vm['spec']['ip_addr'].split('/')[0] for vm in requested]
+    if len(set(addresses)) != len(addresses):
+      raise ProvisionError("same IP address requested for more vms")
+    for vm in requested:
+      error = allocators[vm['net'].id].check(vm['spec']['ip_addr'])
+      if error:
+        raise ProvisionError(vm['name'], "selected IP address is not valid.", error)
+
+    for chunk in chunks(requested):
+      ips = self.nb.ipam.ip_addresses.create([self.ip_data(vm, allocators[vm['net'].id].masked(vm['spec']['ip_addr'])) for vm in chunk])
+      for vm, ip in zip(chunk, ips):
+        vm['ip'] = ip
+      self.sync_rollback()
+
+    for net_id, allocator in allocators.items():
+      net_vms = [vm for vm in self.vms if vm['net'].id == net_id and not vm.get('ip')]
+      try:
+        ips = allocator.allocate([self.ip_data(vm) for vm in net_vms])
+      except ValueError as e:
+        raise ProvisionError("failed to allocate addresses", e)
+      for vm, ip in zip(net_vms, ips):
+        vm['ip'] = ip
+      self.sync_rollback()
+
+    # make sure allocated address is not gateway address
+    for vm in list(self.vms):
+      debug("-", vm['name'], "address", vm['ip'])
+      if vm['ip'].address.split('/')[0] == assume_ip_gateway(vm['net'].prefix):
+        self.vm_failed(vm, "allocated gateway address! fix your netbox")
+
+  def ip_data(self, vm, address=None):
+    ip_data = {
+      "dns_name": vm['fqdn'],
+      "tenant": vm['tenant'].id,
+      "family": 4
+    }
+    if address:
+      ip_data['address'] = address
+    return ip_data
+
+  def vm_data(self, vm):
+    spec = vm['spec']
+    return {
+      "name": spec['name'],
+      "status": 'planned',
+      "cluster": vm['cluster'].id,
+      "role": {'slug': 'server'},
+      "site": vm['site'].id,
+      "tenant": vm['tenant'].id,
+      "platform": vm['platform'].id,
+      "vcpus": spec['cpus'],
+      "memory": spec['ram_size'],
+      "disk": spec['disk_size'],
+      "custom_fields": {
+        "uuid": vm['uuid'],
+        "storage_device": [x.id for x in vm['storage_devices']],
+        "storage_pool": spec['storage_pool'],
+        "storage_type": spec['storage_type'],
+        "storage_id": vm['lun'],
+      }
+    }
+
+  # bulk create one object per vm, stored as vm[key]. netbox creates
+  # nothing of a failed chunk, so with vm rollback scope the chunk is
+  # retried one vm at a time and only vms netbox refuses are dropped.
+  def create_objects(self, endpoint, key, data):
+    for chunk in chunks(list(self.vms)):
+      try:
+        created = endpoint.create([data(vm) for vm in chunk])
+      except pynetbox.RequestError as e:
+        if not self.per_vm_rollback:
+          raise
+        warn("!! bulk create of", len(chunk), key + "s failed, retrying one by one:", e.error)
+        created = []
+        for vm in chunk:
+          try:
+            created.append(endpoint.create(data(vm)))
+          except pynetbox.RequestError as e:
+            created.append(e)
+      for vm, obj in zip(chunk, created):
+        if isinstance(obj, pynetbox.RequestError):
+          self.vm_failed(vm, "failed to create", key, obj.error)
+        else:
+          vm[key] = obj
+      self.sync_rollback()
+
+  def create_vms(self):
+    self.create_objects(self.nb.virtualization.virtual_machines, 'vm', self.vm_data)
+
+  # make sure luns are still unique, one query per cluster
+  def check_luns(self):
+    for cluster_id in set(vm['cluster'].id for vm in self.vms):
+      cluster_vms = [vm for vm in self.vms if vm['cluster'].id == cluster_id]
+      holders = {}
+      for chunk in chunks(sorted(set(vm['lun'] for vm in cluster_vms))):
+        for obj in self.nb.virtualization.virtual_machines.filter(cluster_id=cluster_id, cf_storage_id=chunk, **projection(['name', 'custom_fields'])):
+          holders.setdefault(obj.custom_fields['storage_id'], []).append(obj.id)
+      for vm in cluster_vms:
+        if holders.get(vm['lun'], []) != [vm['vm'].id]:
+          self.vm_failed(vm, "potential lun conflict detected. re-run netbox_create_vm.py")
+
+  def create_interfaces(self):
+    self.create_objects(self.nb.virtualization.interfaces, 'iface', lambda vm: {
+      "virtual_machine": vm['vm'].id,
+      "name": "eth0",
+      "type": 'virtual',
+      "mac_address": vm['mac'],
+      "mode": "access",
+      "untagged_vlan": vm['net'].vlan.id
+    })
+
+  # assign addresses to interfaces and make them primary
+  def update_objects(self):
+    for chunk in chunks(self.vms):
+      self.nb.ipam.ip_addresses.update([{
+        "id": vm['ip'].id,
+        "assigned_object_id": vm['iface'].id,
+        "assigned_object_type": "virtualization.vminterface",
+      } for vm in chunk])
+    for chunk in chunks(self.vms):
+      updates = []
+      for vm in chunk:
+        data = {"id": vm['vm'].id, "primary_ip4": vm['ip'].id}
+        # if upgrade_interval is present, set it to 30 days
+        if 'upgrade_interval' in vm['vm'].custom_fields:
+          data['custom_fields'] = {'upgrade_interval': 30}
+        updates.append(data)
+      self.nb.virtualization.virtual_machines.update(updates)
+
+  def run(self):
+    self.resolve()
+    self.allocate_uuids()
+    self.allocate_macs()
+    self.allocate_luns()
+    debug("- pre-flight checks passed for", len(self.vms), "vms")
+    if self.transactional:
+      return self.run_staged()
+    self.allocate_ips()
+    self.create_vms()
+    self.check_luns()
+    self.create_interfaces()
+    self.update_objects()
+    return [vm['vm'] for vm in self.vms]
+
+  # transactional mode. everything is allocated locally, validated with
+  # targeted reads right before commit and written in four bulk requests
+  # per chunk: vms, interfaces, addresses (already assigned) and primary ips.
+  # conflicting allocations are replaced and commit retried.
+
+  def stage_ips(self):
+    requested = [vm for vm in self.vms if vm['spec']['ip_addr']]
+    addresses = [vm['spec']['ip_addr'].split('/')[0] for vm in requested]
+    if len(set(addresses)) != len(addresses):
+      raise ProvisionError("same IP address requested for more vms")
+    allocators = {}
+    for vm in requested:
+      if vm['net'].id not in allocators:
+        allocators[vm['net'].id] = IpAllocator(self.nb, vm['net'])
+      error = allocators[vm['net'].id].check(vm['spec']['ip_addr'])
+      if error:
+        raise ProvisionError(vm['name'], "selected IP address is not valid.", error)
+      vm['address'] = allocators[vm['net'].id].masked(vm['spec']['ip_addr'])
+      # free addresses of prefix must not include requested ones
+      self.ip_skip.setdefault(vm['net'].id, set()).add(vm['address'])
+
+    for net_id in set(vm['net'].id for vm in self.vms):
+      net_vms = [vm for vm in self.vms if vm['net'].id == net_id and not vm['spec']['ip_addr']]
+      if not net_vms:
+        continue
+      net = net_vms[0]['net']
+      skip = self.ip_skip.setdefault(net_id, set())
+      # never hand out gateway address
+      skip.add("%s/%d" % (assume_ip_gateway(net.prefix), ipaddress.ip_network(net.prefix).prefixlen))
+      free = IpAllocator(self.nb, net).free(len(net_vms), skip)
+      if len(free) < len(net_vms):
+        raise ProvisionError("not enough free addresses in", net.prefix)
+      for vm, address in zip(net_vms, free):
+        vm['address'] = address
+
+    # find_conflicts() compares with netbox only, batch must be unique itself
+    staged = [(vm['address'].split('/')[0], vm['net'].vrf.id if vm['net'].vrf else None) for vm in self.vms]
+    if len(set(staged)) != len(staged):
+      raise ProvisionError("same IP address staged for more vms")
+
+  # targeted reads of staged values, returns [(kind, vm), ...] of conflicts
+  def find_conflicts(self, committed=False):
+    vm_ep = self.nb.virtualization.virtual_machines
+    own = set(vm['vm'].id for vm in self.vms if vm.get('vm'))
+
+    # with short uuids, first segment must be unique, same as UuidIndex
+    def uuids():
+      key = (lambda uuid: uuid.split('-')[0]) if self.short_uuids else (lambda uuid: uuid)
+      lookup = 'cf_uuid__isw' if self.short_uuids else 'cf_uuid'
+      taken = set()
+      for chunk in chunks(sorted(set(key(vm['uuid']) for vm in self.vms))):
+        for obj in vm_ep.filter(**{lookup: chunk, 'fields': 'id,custom_fields'}):
+          uuid = (obj.custom_fields or {}).get('uuid')
+          if obj.id not in own and uuid:
+            taken.add(key(uuid))
+      return [('uuid', vm) for vm in self.vms if key(vm['uuid']) in taken]
+
+    def luns():
+      res = []
+      for cluster_id in set(vm['cluster'].id for vm in self.vms):
+        cluster_vms = [vm for vm in self.vms if vm['cluster'].id == cluster_id]
+        taken = set()
+        for chunk in chunks(sorted(set(vm['lun'] for vm in cluster_vms))):
+          for obj in vm_ep.filter(cluster_id=cluster_id, cf_storage_id=chunk, **projection(['custom_fields'])):
+            if obj.id not in own:
+              taken.add(obj.custom_fields['storage_id'])
+        res += [('lun', vm) for vm in cluster_vms if vm['lun'] in taken]
+      return res
+
+    def macs():
+      own_ifaces = set(vm['iface'].id for vm in self.vms if vm.get('iface'))
+      taken = set()
+      for endpoint, own in ((self.nb.virtualization.interfaces, own_ifaces), (self.nb.dcim.interfaces, set())):
+        for chunk in chunks([vm['mac'] for vm in self.vms]):
+          for obj in endpoint.filter(mac_address=chunk, **projection(['mac_address'])):
+            if obj.id not in own:
+              taken.add(obj.mac_address.lower())
+      return [('mac', vm) for vm in self.vms if vm['mac'].lower() in taken]
+
+    def addresses():
+      own_ips = set(vm['ip'].id for vm in self.vms if vm.get('ip'))
+      taken = set()
+      for chunk in chunks([vm['address'].split('/')[0] for vm in self.vms]):
+        for obj in self.nb.ipam.ip_addresses.filter(address=chunk, **projection(['address', 'vrf'])):
+          if obj.id not in own_ips:
+            taken.add((obj.address.split('/')[0], obj.vrf.id if obj.vrf else None))
+      return [('ip', vm) for vm in self.vms if (vm['address'].split('/')[0], vm['net'].vrf.id if vm['net'].vrf else None) in taken]
+
+    def names():
+      existing = []
+      if not committed:
+        for chunk in chunks([vm['name'] for vm in self.vms]):
+          existing += [x.name for x in vm_ep.filter(name=chunk, **projection(['name']))]
+      return [('name', vm) for vm in self.vms if vm['name'] in existing]
+
+    found = parallel({'uuids': uuids, 'luns': luns, 'macs': macs, 'addresses': addresses, 'names': names}, self.threads)
+    return [x for res in found.values() for x in res]
+
+  # replace conflicting allocations, values requested by user can't be replaced
+  def reallocate(self, conflicts):
+    for kind, vm in conflicts:
+      spec = vm['spec']
+      requested = {'uuid': spec['uuid'], 'mac': spec['mac_addr'], 'lun': spec['storage_fixed_lun'], 'ip': spec['ip_addr'], 'name': spec['name']}
+      if requested[kind]:
+        raise ProvisionError(vm['name'], kind, "conflicts with existing object")
+      warn(vm['name'], kind, "conflict, allocating new one")
+      if kind == 'uuid':
+        vm['uuid'] = self.uuids.generate(self.short_uuids)
+        if not vm['uuid']:
+          raise ProvisionError(vm['name'], "faield to generate unique uuid")
+      elif kind == 'mac':
+        self.macs.reserve(vm['mac'])
+        mac = self.macs.allocate()
+        if not mac:
+          raise ProvisionError("no free mac addresses left")
+        vm['mac'] = mac[0]
+      elif kind == 'lun':
+        luns = self.luns.setdefault(vm['cluster'].id, LunAllocator(self.nb, vm['cluster'].id, threads=self.threads))
+        luns.reserve(vm['lun'])
+        lun = luns.allocate()
+        if not lun:
+          raise ProvisionError('failed to assign lun in cluster', vm['cluster'])
+        vm['lun'] = lun[0]
+      elif kind == 'ip':
+        self.ip_skip.setdefault(vm['net'].id, set()).add(vm['address'])
+
+  def commit(self):
+    self.create_vms()
+    self.create_interfaces()
+    for chunk in chunks(self.vms):
+      created = self.nb.ipam.ip_addresses.create([dict(self.ip_data(vm, vm['address']), **{
+        "assigned_object_type": "virtualization.vminterface",
+        "assigned_object_id": vm['iface'].id,
+      }) for vm in chunk])
+      for vm, ip in zip(chunk, created):
+        vm['ip'] = ip
+      self.sync_rollback()
+    for chunk in chunks(self.vms):
+      updates = []
+      for vm in chunk:
+        data = {"id": vm['vm'].id, "primary_ip4": vm['ip'].id}
+        # if upgrade_interval is present, set it to 30 days
+        if 'upgrade_interval' in vm['vm'].custom_fields:
+          data['custom_fields'] = {'upgrade_interval': 30}
+        updates.append(data)
+      self.nb.virtualization.virtual_machines.update(updates)
+
+  def run_staged(self):
+    for attempt in range(self.retries + 1):
+      self.stage_ips()
+      conflicts = self.find_conflicts()
+      if conflicts:
+        self.reallocate(conflicts)
+        continue
+      self.commit()
+      # someone else could commit same values meanwhile
+      conflicts = self.find_conflicts(committed=True)
+      if not conflicts:
+        for vm in self.vms:
+          debug("-", vm['name'], "address", vm['ip'], "lun", vm['lun'], "mac", vm['mac'])
+        return [vm['vm'] for vm in self.vms]
+      warn("conflict with concurrent change, rolling back", len(self.rollback_list), "objects")
+      rollback_objects(self.nb, self.rollback_list)
+      for vm in self.vms:
+        for x in ('ip', 'iface', 'vm'):
+          vm.pop(x, None)
+      self.sync_rollback()
+      self.reallocate(conflicts)
+    raise ProvisionError("conflicts persist after", self.retries, "retries")
@@ -0,0 +1,36 @@
+# bulk reconciliation of object descriptions, shared by naming scripts.
+#
+# prefixes are indexed by vlan id once, wanted descriptions are compared
+# in memory and only changed objects are written with chunked bulk PATCH.
+
+from collections import defaultdict
+from netbox_tools.fetch import fetch_all, fetch_iter, chunks, projection
+
+PREFIX_FIELDS = ['prefix', 'vlan', 'description']
+
+
+# {vlan id: [prefix, ...]} in netbox order, and prefixes without vlan.
+# with vlan_ids only prefixes of those vlans are fetched.
+def prefixes_by_vlan(nb, vlan_ids=None, threads=None):
+  if vlan_ids == None:
+    prefixes = fetch_all(nb.ipam.prefixes, threads, **projection(PREFIX_FIELDS))
+  else:
+    prefixes = []
+    for ids in chunks(sorted(set(vlan_ids))):
+      prefixes.extend(fetch_iter(nb.ipam.prefixes, threads, vlan_id=ids, **projection(PREFIX_FIELDS)))
+  index = defaultdict(list)
+  without_vlan = []
+  for prefix in prefixes:
+    if prefix.vlan:
+      index[prefix.vlan.id].append(prefix)
+    else:
+      without_vlan.append(prefix)
+  return index, without_vlan
+
+# [(obj, old, new), ...] for (obj, wanted description) pairs which differ
+def description_changes(pairs):
+  return [(obj, obj.description, wanted) for obj, wanted in pairs if obj.description != wanted]
+
+def apply_changes(endpoint, changes, field='description'):
+  for chunk in chunks(changes):
+    endpoint.update([{'id': obj.id, field: new} for obj, old, new in chunk])
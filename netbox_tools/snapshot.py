@@ -0,0 +1,419 @@
+# compact, memory-mapped inventory snapshot for read-only scripts.
+#
+# objects are stored column by column (see SCHEMA) as flat arrays. strings
+# are interned into one sorted string table and columns hold only string ids.
+# file is memory-mapped, so loading is nearly free, and records are built
+# only for rows a script actually asks for.
+#
+# file layout:
+#   magic (8 bytes), metadata length (uint64), metadata (json), padding,
+#   data blocks aligned to 8 bytes. metadata describes position of every block.
+#
+# scripts select snapshot with --snapshot FILE or NETBOX_SNAPSHOT env,
+# see cache.add_cache_arguments(). netbox_snapshot.py writes the file.
+
+import os,sys,json,mmap,struct
+from array import array
+from netbox_tools.cache import ASSIGNED_FILTERS, LIST_FILTERS, get_endpoint
+from netbox_tools.fetch import fetch_iter, projection
+
+MAGIC = b'NBSNAP01'
+NULL_INT = -2**63
+NULL_STR = -1
+
+# column kinds and their array type codes.
+# str and json are string ids, json holds json encoded value.
+TYPECODES = {'str': 'i', 'json': 'i', 'int': 'q', 'float': 'd', 'bool': 'b'}
+
+# stored columns per endpoint. "*" marks list, eg. tagged_vlans.*.vid
+SCHEMA = {
+  'devices': [
+    ('id', 'int'), ('name', 'str'), ('status.value', 'str'), ('status.label', 'str'),
+    ('role.id', 'int'), ('role.name', 'str'), ('role.slug', 'str'),
+    ('site.id', 'int'), ('site.slug', 'str'), ('cluster.id', 'int'), ('cluster.name', 'str'),
+    ('tenant.id', 'int'), ('tenant.name', 'str'), ('tenant.slug', 'str'),
+    ('platform.slug', 'str'),
+    ('primary_ip.id', 'int'), ('primary_ip.address', 'str'),
+    ('primary_ip4.id', 'int'), ('primary_ip4.address', 'str'),
+    ('custom_fields', 'json'), ('config_context', 'json'),
+  ],
+  'virtual_machines': [
+    ('id', 'int'), ('name', 'str'), ('status.value', 'str'), ('status.label', 'str'),
+    ('role.id', 'int'), ('role.name', 'str'), ('role.slug', 'str'),
+    ('site.id', 'int'), ('site.slug', 'str'), ('cluster.id', 'int'), ('cluster.name', 'str'),
+    ('tenant.id', 'int'), ('tenant.name', 'str'), ('tenant.slug', 'str'),
+    ('platform.slug', 'str'),
+    ('primary_ip.id', 'int'), ('primary_ip.address', 'str'),
+    ('primary_ip4.id', 'int'), ('primary_ip4.address', 'str'),
+    ('vcpus', 'float'), ('memory', 'int'), ('disk', 'int'),
+    ('custom_fields', 'json'), ('config_context', 'json'),
+  ],
+  'interfaces': [
+    ('id', 'int'), ('name', 'str'), ('device.id', 'int'), ('device.name', 'str'),
+    ('type.value', 'str'), ('enabled', 'bool'), ('mgmt_only', 'bool'), ('mtu', 'int'),
+    ('mac_address', 'str'), ('mode.value', 'str'), ('mode.label', 'str'),
+    ('untagged_vlan.id', 'int'), ('untagged_vlan.vid', 'int'), ('untagged_vlan.name', 'str'),
+    ('tagged_vlans.*.id', 'int'), ('tagged_vlans.*.vid', 'int'),
+    ('lag.id', 'int'), ('lag.name', 'str'), ('parent.id', 'int'), ('parent.name', 'str'),
+    ('vdcs.*.id', 'int'), ('vdcs.*.name', 'str'), ('tags.*.slug', 'str'),
+    ('description', 'str'), ('count_ipaddresses', 'int'), ('custom_fields', 'json'),
+  ],
+  'vm_interfaces': [
+    ('id', 'int'), ('name', 'str'), ('virtual_machine.id', 'int'), ('virtual_machine.name', 'str'),
+    ('enabled', 'bool'), ('mtu', 'int'), ('mac_address', 'str'), ('mode.value', 'str'), ('mode.label', 'str'),
+    ('untagged_vlan.id', 'int'), ('untagged_vlan.vid', 'int'), ('untagged_vlan.name', 'str'),
+    ('tagged_vlans.*.id', 'int'), ('tagged_vlans.*.vid', 'int'),
+    ('parent.id', 'int'), ('parent.name', 'str'), ('tags.*.slug', 'str'),
+    ('description', 'str'), ('count_ipaddresses', 'int'), ('custom_fields', 'json'),
+  ],
+  'ip_addresses': [
+    ('id', 'int'), ('address', 'str'), ('dns_name', 'str'), ('display', 'str'),
+    ('vrf.id', 'int'), ('vrf.name', 'str'), ('status.value', 'str'),
+    ('tenant.id', 'int'), ('tenant.slug', 'str'),
+    ('assigned_object_type', 'str'), ('assigned_object_id', 'int'),
+    ('assigned_object.name', 'str'),
+    ('assigned_object.device.id', 'int'), ('assigned_object.device.name', 'str'),
+    ('assigned_object.virtual_machine.id', 'int'), ('assigned_object.virtual_machine.name', 'str'),
+    ('description', 'str'),
+  ],
+  'prefixes': [
+    ('id', 'int'), ('prefix', 'str'), ('description', 'str'), ('status.value', 'str'),
+    ('vlan.id', 'int'), ('vlan.vid', 'int'), ('vlan.name', 'str'),
+    ('vrf.id', 'int'), ('tenant.id', 'int'), ('tenant.slug', 'str'),
+  ],
+  'vlans': [
+    ('id', 'int'), ('vid', 'int'), ('name', 'str'), ('status.value', 'str'),
+    ('site.id', 'int'), ('site.slug', 'str'), ('group.id', 'int'), ('group.slug', 'str'),
+    ('tenant.id', 'int'), ('tenant.slug', 'str'),
+  ],
+  'services': [
+    ('id', 'int'), ('name', 'str'), ('description', 'str'), ('protocol.value', 'str'),
+    ('ports.*', 'int'), ('virtual_machine.id', 'int'), ('virtual_machine.name', 'str'),
+    ('device.id', 'int'), ('device.name', 'str'),
+    ('ipaddresses.*.id', 'int'), ('ipaddresses.*.address', 'str'), ('tags.*.slug', 'str'),
+  ],
+}
+
+
+def align(n):
+  return (n + 7) & ~7
+
+def get_path(obj, parts):
+  for part in parts:
+    if not isinstance(obj, dict):
+      return None
+    obj = obj.get(part)
+  return obj
+
+# set obj[a][b][c] = value, creating nested dicts on the way
+def set_path(obj, parts, value):
+  for part in parts[:-1]:
+    if obj.get(part) == None:
+      obj[part] = {}
+    obj = obj[part]
+  obj[parts[-1]] = value
+
+# nested objects with nothing but nulls were null in netbox
+def prune(obj):
+  for k, v in obj.items():
+    if isinstance(v, dict):
+      prune(v)
+      if all(x == None for x in v.values()):
+        obj[k] = None
+
+
+class SnapshotWriter:
+  def __init__(self):
+    self.strings = {}
+    self.tables = {}
+
+  def intern(self, value):
+    if value == None:
+      return NULL_STR
+    return self.strings.setdefault(value, len(self.strings))
+
+  def encode(self, kind, value):
+    if kind == 'str':
+      return self.intern(str(value) if value != None else None)
+    if kind == 'json':
+      return self.intern(json.dumps(value, sort_keys=True) if value != None else None)
+    if kind == 'int':
+      return NULL_INT if value == None else int(value)
+    if kind == 'float':
+      return float('nan') if value == None else float(value)
+    if kind == 'bool':
+      return -1 if value == None else int(bool(value))
+
+  # add table from iterable of raw objects (dicts as returned by netbox)
+  def add_table(self, name, rows):
+    columns = []
+    for path, kind in SCHEMA[name]:
+      parts = path.split('.')
+      col = {'path': path, 'kind': kind, 'values': array(TYPECODES[kind])}
+      if '*' in parts:
+        col['list'] = (parts[:parts.index('*')], parts[parts.index('*')+1:])
+        col['offsets'] = array('q', [0])
+      else:
+        col['parts'] = parts
+      columns.append(col)
+
+    count = 0
+    for row in rows:
+      count += 1
+      for col in columns:
+        if 'list' in col:
+          head, tail = col['list']
+          items = get_path(row, head) or []
+          for item in items:
+            col['values'].append(self.encode(col['kind'], get_path(item, tail) if tail else item))
+          col['offsets'].append(len(col['values']))
+        else:
+          col['values'].append(self.encode(col['kind'], get_path(row, col['parts'])))
+    self.tables[name] = {'rows': count, 'columns': columns}
+
+  def save(self, path):
+    # sort string table, so lookups can use binary search, and remap ids
+    strings = sorted(self.strings)
+    remap = array('i', [0] * len(strings))
+    for new_id, s in enumerate(strings):
+      remap[self.strings[s]] = new_id
+
+    blocks = []
+    position = [0]
+    def add_block(data):
+      meta = {'offset': position[0], 'length': len(data)}
+      blocks.append(data + b'\0' * (align(len(data)) - len(data)))
+      position[0] += align(len(data))
+      return meta
+
+    encoded = [s.encode() for s in strings]
+    offsets = array('q', [0])
+    for s in encoded:
+      offsets.append(offsets[-1] + len(s))
+    meta = {
+      'byteorder': sys.byteorder,
+      'strings': {'count': len(strings), 'offsets': add_block(offsets.tobytes()), 'data': add_block(b''.join(encoded))},
+      'tables': {},
+    }
+
+    for name, table in self.tables.items():
+      columns = {}
+      for col in table['columns']:
+        values = col['values']
+        if col['kind'] in ('str', 'json'):
+          values = array('i', (remap[x] if x != NULL_STR else NULL_STR for x in values))
+        columns[col['path']] = {'kind': col['kind'], 'values': add_block(values.tobytes())}
+        if 'offsets' in col:
+          columns[col['path']]['offsets'] = add_block(col['offsets'].tobytes())
+      meta['tables'][name] = {'rows': table['rows'], 'columns': columns}
+
+    header = json.dumps(meta).encode()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+      f.write(b'\0' * (align(16 + len(header)) - 16 - len(header)))
+      for block in blocks:
+        f.write(block)
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.mm[:8] != MAGIC:
+      raise ValueError("not a netbox snapshot file: %s" % path)
+    header_len = struct.unpack('<Q', self.mm[8:16])[0]
+    self.meta = json.loads(self.mm[16:16+header_len])
+    if self.meta['byteorder'] != sys.byteorder:
+      raise ValueError("snapshot byte order does not match this machine")
+    self.base = align(16 + header_len)
+    self.view = memoryview(self.mm)
+    self.string_offsets = self.block(self.meta['strings']['offsets'], 'q')
+    self.string_data = self.block(self.meta['strings']['data'], 'B')
+    self.tables = {}
+
+  def block(self, meta, typecode):
+    start = self.base + meta['offset']
+    return self.view[start:start + meta['length']].cast(typecode)
+
+  def string(self, sid):
+    if sid == NULL_STR:
+      return None
+    return bytes(self.string_data[self.string_offsets[sid]:self.string_offsets[sid+1]]).decode()
+
+  # string id of value or None when not present in snapshot
+  def string_id(self, value):
+    lo, hi = 0, self.meta['strings']['count']
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.string(mid) < value:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self.meta['strings']['count'] and self.string(lo) == value:
+      return lo
+    return None
+
+  def table(self, name):
+    if name not in self.meta['tables']:
+      raise KeyError(name)
+    if name not in self.tables:
+      self.tables[name] = SnapshotTable(self, name, self.meta['tables'][name])
+    return self.tables[name]
+
+
+class SnapshotTable:
+  def __init__(self, snapshot, name, meta):
+    self.snapshot = snapshot
+    self.name = name
+    self.rows = meta['rows']
+    self.columns = {}
+    for path, col in meta['columns'].items():
+      self.columns[path] = {
+        'kind': col['kind'],
+        'parts': path.split('.'),
+        'values': snapshot.block(col['values'], TYPECODES[col['kind']]),
+        'offsets': snapshot.block(col['offsets'], 'q') if 'offsets' in col else None,
+      }
+    self.index = {}
+
+  def decode(self, kind, raw):
+    if kind == 'str':
+      return self.snapshot.string(raw)
+    if kind == 'json':
+      return None if raw == NULL_STR else json.loads(self.snapshot.string(raw))
+    if kind == 'int':
+      return None if raw == NULL_INT else raw
+    if kind == 'float':
+      return None if raw != raw else raw
+    if kind == 'bool':
+      return None if raw == -1 else bool(raw)
+
+  def raw_values(self, col, i):
+    if col['offsets'] != None:
+      return col['values'][col['offsets'][i]:col['offsets'][i+1]]
+    return (col['values'][i],)
+
+  # rebuild raw netbox object of row i
+  def row(self, i):
+    row = {}
+    json_values = []
+    for path, col in self.columns.items():
+      parts = col['parts']
+      if col['kind'] == 'json':
+        json_values.append((parts, self.decode('json', col['values'][i])))
+      elif col['offsets'] != None:
+        head, tail = parts[:parts.index('*')], parts[parts.index('*')+1:]
+        values = [self.decode(col['kind'], x) for x in self.raw_values(col, i)]
+        if not tail:
+          set_path(row, head, values)
+          continue
+        items = get_path(row, head)
+        if items == None:
+          items = [{} for _ in values]
+          set_path(row, head, items)
+        for item, value in zip(items, values):
+          set_path(item, tail, value)
+      else:
+        set_path(row, parts, self.decode(col['kind'], col['values'][i]))
+    prune(row)
+    for parts, value in json_values:
+      set_path(row, parts, value)
+    return row
+
+  def record(self, i):
+    endpoint = get_endpoint(self.snapshot.nb, self.name)
+    return endpoint.return_obj(self.row(i), self.snapshot.nb, endpoint)
+
+  # columns compared by filter key, same semantics as cache.row_matches
+  def filter_columns(self, key):
+    if key in LIST_FILTERS:
+      key = LIST_FILTERS[key] + '.*'
+    if key in self.columns:
+      return [key]
+    nested = [key + '.' + x for x in ('id', 'name', 'slug', 'value') if key + '.' + x in self.columns]
+    if nested:
+      return nested
+    field, _, attr = key.rpartition('_')
+    if field + '.' + attr in self.columns:
+      return [field + '.' + attr]
+    # ip addresses match parent of assigned interface, eg. device_id
+    if 'assigned_object.' + field + '.' + attr in self.columns:
+      return ['assigned_object.' + field + '.' + attr]
+    raise KeyError(key)
+
+  # encode filter values into raw column values
+  def encode_values(self, kind, values):
+    res = set()
+    for value in values:
+      if kind in ('str',) and isinstance(value, str):
+        sid = self.snapshot.string_id(value)
+        if sid != None:
+          res.add(sid)
+      elif kind == 'int' and not isinstance(value, bool):
+        try:
+          res.add(int(value))
+        except (TypeError, ValueError):
+          pass
+      elif kind == 'bool' and isinstance(value, bool):
+        res.add(int(value))
+    return res
+
+  def column_matcher(self, key, value):
+    values = value if isinstance(value, list) else [value]
+    if key in ASSIGNED_FILTERS:
+      type_col = self.columns['assigned_object_type']
+      id_col = self.columns['assigned_object_id']
+      type_ids = self.encode_values('str', [ASSIGNED_FILTERS[key]])
+      obj_ids = self.encode_values('int', values)
+      return lambda i: type_col['values'][i] in type_ids and id_col['values'][i] in obj_ids
+    checks = []
+    for path in self.filter_columns(key):
+      col = self.columns[path]
+      checks.append((col, self.encode_values(col['kind'], values)))
+    return lambda i: any(x in raw for col, raw in checks for x in self.raw_values(col, i))
+
+  def find(self, **filters):
+    candidates = range(self.rows)
+    # names are indexed, everything else is a column scan
+    if isinstance(filters.get('name'), str) and 'name' in self.columns:
+      if 'name' not in self.index:
+        self.index['name'] = {}
+        for i, sid in enumerate(self.columns['name']['values']):
+          self.index['name'].setdefault(sid, []).append(i)
+      candidates = self.index['name'].get(self.snapshot.string_id(filters['name']), [])
+    matchers = [self.column_matcher(k, v) for k, v in filters.items()]
+    return [i for i in candidates if all(m(i) for m in matchers)]
+
+
+# list of records built on access
+class RecordView:
+  def __init__(self, table, indices):
+    self.table = table
+    self.indices = indices
+
+  def __len__(self):
+    return len(self.indices)
+
+  def __getitem__(self, i):
+    return self.table.record(self.indices[i])
+
+  def __iter__(self):
+    for i in self.indices:
+      yield self.table.record(i)
+
+
+def open_snapshot(nb, path):
+  snapshot = Snapshot(path)
+  snapshot.nb = nb
+  return snapshot
+
+
+def write_snapshot(nb, path, names=None, threads=None):
+  writer = SnapshotWriter()
+  for name in names or SCHEMA.keys():
+    fields = projection([column for column, _ in SCHEMA[name]])
+    writer.add_table(name, (dict(x) for x in fetch_iter(get_endpoint(nb, name), threads, **fields)))
+  writer.save(path)
+  return writer
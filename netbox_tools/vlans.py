@@ -0,0 +1,97 @@
+# vlan lookups by vid. only requested vids are queried, contiguous ranges
+# with vid__gte/vid__lte and short ones as vid= lists.
+
+from collections import defaultdict
+from netbox_tools.fetch import fetch_iter, chunks
+
+# ranges shorter than this are queried as vid= list
+RANGE_MIN = 32
+
+
+# sorted vids as [(lo, hi), ...] ranges
+def vid_ranges(vids):
+  res = []
+  for vid in sorted(vids):
+    if res and res[-1][1] == vid - 1:
+      res[-1] = (res[-1][0], vid)
+    else:
+      res.append((vid, vid))
+  return res
+
+# all vlans with requested vids, optionally scoped by site or vlan group slug.
+# site 'null' selects vlans without site.
+def fetch_vlans(nb, vids, site=None, group=None, threads=None):
+  filters = {}
+  if site == 'null':
+    filters['site_id'] = 'null'
+  elif site:
+    filters['site'] = site
+  if group:
+    filters['group'] = group
+
+  res = []
+  short = []
+  for lo, hi in vid_ranges(vids):
+    if hi - lo + 1 >= RANGE_MIN:
+      res += fetch_iter(nb.ipam.vlans, threads, vid__gte=lo, vid__lte=hi, **filters)
+    else:
+      short += range(lo, hi + 1)
+  for chunk in chunks(short):
+    res += nb.ipam.vlans.filter(vid=chunk, **filters)
+  return [x for x in res if x.vid in vids]
+
+# vid -> vlan id. returns (vid_ids, duplicates, missing), where duplicates
+# holds {vid: [vlan, ...]} of vids found more than once in scope. such vids
+# are left out of vid_ids. with site, only vlans of the site are queried and
+# vids the site has not are looked up among vlans without site (global or
+# group ones), so vlan of the site wins over global one with same vid.
+def resolve_vids(nb, vids, site=None, group=None, threads=None):
+  vids = set(vids)
+  found = defaultdict(list)
+  for vlan in fetch_vlans(nb, vids, site, group, threads):
+    found[vlan.vid].append(vlan)
+  if site:
+    for vlan in fetch_vlans(nb, vids.difference(found), 'null', group, threads):
+      found[vlan.vid].append(vlan)
+  vid_ids = {vid: vlans[0].id for vid, vlans in found.items() if len(vlans) == 1}
+  duplicates = {vid: vlans for vid, vlans in found.items() if len(vlans) > 1}
+  missing = vids.difference(found)
+  return vid_ids, duplicates, missing
+
+# describe where vlan lives, for duplicate reports
+def vlan_scope(vlan):
+  if vlan.group:
+    return "group %s" % vlan.group.slug
+  if vlan.site:
+    return "site %s" % vlan.site.slug
+  return "global"
+
+
+# vlan membership across hosts as bitsets, bit i set for i-th host
+class VlanMembership:
+  def __init__(self, hosts):
+    self.hosts = list(hosts)
+    self.index = {host: i for i, host in enumerate(self.hosts)}
+    self.members = defaultdict(int)
+    self.all = (1 << len(self.hosts)) - 1
+
+  def add(self, host, vids):
+    bit = 1 << self.index[host]
+    for vid in vids:
+      self.members[vid] |= bit
+
+  def host_names(self, mask):
+    return [host for host, i in self.index.items() if mask & (1 << i)]
+
+  def vids(self, host):
+    bit = 1 << self.index[host]
+    return set(vid for vid, mask in self.members.items() if mask & bit)
+
+  # {vid: [host, ...]} of vlans present on some hosts, but not all of them
+  def missing(self, required=()):
+    res = {}
+    for vid in set(self.members).union(required):
+      mask = self.all & ~self.members.get(vid, 0)
+      if mask:
+        res[vid] = self.host_names(mask)
+    return res
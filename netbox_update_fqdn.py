@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 
 from sys import stderr,exit,argv
-import json,yaml,os,ipaddress,random,pynetbox
+import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, fetch_all, chunks, projection
+from netbox_tools.pipeline import parallel, split_threads
+from netbox_tools.output import FORMATS, write_objects
+
+doc = """
+Audit that VM name, "fqdn" custom field and name of tcp/22 service match DNS
+name of VM primary IPv4 address. VMs, IP addresses and services are loaded
+in bulk and joined in memory. With --fix, "fqdn" custom field and service
+names are set to DNS name of primary IP with bulk PATCH. VM names, missing
+primary IPs and missing services are only reported.
+"""
+
+REPORT_FIELDS = ['vm', 'check', 'expected', 'actual']
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -14,42 +28,82 @@ def warn(*messages):
   print(*messages, file=stderr)
 
 
-
-nb = pynetbox.api(os.getenv('NETBOX_API_URL'), token=os.getenv('NETBOX_TOKEN'))
-
-# fetch all vms
-vms = nb.virtualization.virtual_machines.all()
-ids = {}
-for vm in vms:
-
-  vm_name = vm['name']
-  ip_name = None
-  service_name = None
-
-  ip = nb.ipam.ip_addresses.get(id=vm.primary_ip4.id)
-  if ip:
-    ip_name = ip.dns_name
-
-  services = nb.ipam.services.filter(virtual_machine_id=vm.id, protocol="tcp", port=22)
-  if len(services) == 0:
-    warn(vm_name, "is missing tcp/22 service")
-  service = list(services)[0]
-  service_name = service['name']
-
-  if ip_name!=service_name:
-    warn(vm_name, "ip_name and service_name differ")
-
-  if '.' in vm_name and vm_name != ip_name:
-    warn(vm_name, "differs from", ip_name)
-
- 
-  #vm['custom_fields']['fqdn'] = ip_name
-  #vm.save()
-  #ip.dns_name = ip_name
-
-
-  #print(vm.name, "->", vm_name)
-  #vm.name = "vm-"+vm_id
-  #vm.save()
-
-
+# vms, their primary ips and tcp/22 services, fetched concurrently.
+# threads are split among the three lists.
+def load(nb, threads):
+  each = split_threads(threads, 3)
+  return parallel({
+    'vms': lambda: fetch_all(nb.virtualization.virtual_machines, each, **projection(['name', 'primary_ip4', 'custom_fields'])),
+    'ips': lambda: fetch_all(nb.ipam.ip_addresses, each, assigned_object_type='virtualization.vminterface', **projection(['address', 'dns_name'])),
+    'services': lambda: fetch_all(nb.ipam.services, each, protocol='tcp', port=22, **projection(['name', 'virtual_machine'])),
+  }, threads)
+
+# mismatches as report rows, fixes as {endpoint: [patch, ...]}
+def audit(vms, ips, services):
+  ips = {x.id: x for x in ips}
+  vm_services = {}
+  for service in services:
+    if service.virtual_machine:
+      vm_services.setdefault(service.virtual_machine.id, []).append(service)
+
+  report = []
+  fixes = {'vms': [], 'services': []}
+  def mismatch(vm, check, expected, actual):
+    report.append({'vm': vm.name, 'check': check, 'expected': expected, 'actual': actual})
+
+  for vm in vms:
+    ip_name = None
+    if not vm.primary_ip4:
+      mismatch(vm, 'primary-ip', 'ipv4', None)
+    elif vm.primary_ip4.id not in ips:
+      mismatch(vm, 'primary-ip', 'vm-interface', vm.primary_ip4.address)
+    else:
+      ip_name = ips[vm.primary_ip4.id].dns_name or None
+      if not ip_name:
+        mismatch(vm, 'dns-name', 'set', None)
+
+    services = vm_services.get(vm.id, [])
+    if len(services) == 0:
+      mismatch(vm, 'service', 'tcp/22', None)
+    for service in services:
+      if ip_name and service.name != ip_name:
+        mismatch(vm, 'service-name', ip_name, service.name)
+        fixes['services'].append({'id': service.id, 'name': ip_name})
+
+    if ip_name and vm.custom_fields.get('fqdn') != ip_name:
+      mismatch(vm, 'fqdn', ip_name, vm.custom_fields.get('fqdn'))
+      fixes['vms'].append({'id': vm.id, 'custom_fields': {'fqdn': ip_name}})
+
+    if ip_name and '.' in vm.name and vm.name != ip_name:
+      mismatch(vm, 'vm-name', ip_name, vm.name)
+
+  return report, fixes
+
+
+def main():
+  parser = argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
+  parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
+  parser.add_argument('-f', '--format', help='Report format (defaults to text)', choices=FORMATS, default='text')
+  parser.add_argument('--fix', help='Set "fqdn" custom field and service names to DNS name of primary IP', action='store_true')
+  add_fetch_arguments(parser)
+  args = parser.parse_args()
+
+  nb = connect(args.api_url, args.token)
+
+  data = load(nb, args.threads)
+  report, fixes = audit(data['vms'], data['ips'], data['services'])
+  write_objects(report, args.format, REPORT_FIELDS)
+
+  if not args.fix:
+    exit(1 if report else 0)
+
+  # bulk PATCH in chunks
+  for endpoint, items in ((nb.virtualization.virtual_machines, fixes['vms']), (nb.ipam.services, fixes['services'])):
+    for chunk in chunks(items):
+      endpoint.update(chunk)
+  warn("fixed", len(fixes['vms']), "vms and", len(fixes['services']), "services")
+
+
+if __name__ == "__main__":
+  main()
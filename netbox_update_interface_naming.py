@@ -5,6 +5,9 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse,re
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, fetch_all, fetch_iter, chunks, projection
+from netbox_tools.reconcile import prefixes_by_vlan, description_changes, apply_changes
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -19,40 +22,60 @@ def debug(*messages):
 parser = argparse.ArgumentParser()
 parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
 parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
-parser.add_argument('-H', '--host', help='Device name.', required=True)
+parser.add_argument('-H', '--host', help='Device name.')
+parser.add_argument('-s', '--site', help='All devices in site (slug)')
+parser.add_argument('-t', '--tenant', help='Only devices of tenant (slug)')
 parser.add_argument('-N', '--no-dry-run', help='Don\'t just show changes but also save them to netbox', action='store_true')
+add_fetch_arguments(parser)
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+if not args.host and not args.site:
+  fail('host or site must be specified')
 
-dev = nb.dcim.devices.get(name=args.host)
-if not dev:
+nb = connect(args.api_url, args.token)
+
+# devices filtered on server
+filters = projection(['name'])
+if args.host:
+  filters['name'] = args.host
+if args.site:
+  filters['site'] = args.site
+if args.tenant:
+  filters['tenant'] = args.tenant
+devs = fetch_all(nb.dcim.devices, args.threads, **filters)
+if not devs:
   fail('no such device')
 
-ifaces = nb.dcim.interfaces.filter(device=dev)
+# interfaces of all devices in bulk
+ifaces = []
+for ids in chunks(x.id for x in devs):
+  ifaces.extend(fetch_iter(nb.dcim.interfaces, args.threads, device_id=ids, **projection(['name', 'device', 'description', 'untagged_vlan', 'count_ipaddresses'])))
 
+# interfaces with addresses are named after prefix of their untagged vlan
+candidates = []
 for iface in ifaces:
   if iface.count_ipaddresses == 0:
-    warn('iface without ip addresses', iface)
+    warn('iface without ip addresses', iface.device.name, iface)
     continue
-
-  ip = nb.ipam.ip_addresses.get(interface_id=iface.id)
-  if not ip:
-    fail('ip address not found on ', iface)
-
   if not iface.untagged_vlan:
-    warn('untagged interface', iface)
+    warn('untagged interface', iface.device.name, iface)
     continue
+  candidates.append(iface)
 
-  prefixes = nb.ipam.prefixes.filter(vlan_id=iface.untagged_vlan.id)
+nets, _ = prefixes_by_vlan(nb, [x.untagged_vlan.id for x in candidates], args.threads)
+
+pairs = []
+for iface in candidates:
+  prefixes = nets.get(iface.untagged_vlan.id, [])
   if len(prefixes) == 0:
-    fail('no prefixed matched ip', ip)
+    warn('no prefix matched vlan of', iface.device.name, iface)
+    continue
   if len(prefixes) > 1:
-    warning('too many prefixes found. using shortest one')
-  prefix = list(prefixes)[-1]
-
-  if iface.description != prefix.description:
-    warn('rename', iface, iface.description, '->', prefix.description)
-    if args.no_dry_run:
-      iface.description = prefix.description
-      iface.save()
+    warn('too many prefixes found. using shortest one', iface.device.name, iface)
+  pairs.append((iface, prefixes[-1].description))
+
+changes = description_changes(pairs)
+for iface, old, new in changes:
+  warn('rename', iface.device.name, iface, old, '->', new)
+if args.no_dry_run:
+  apply_changes(nb.dcim.interfaces, changes)
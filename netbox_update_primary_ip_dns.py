@@ -5,6 +5,9 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse,re
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, fetch_all, fetch_by_ids, chunks, projection
+from netbox_tools.pipeline import parallel, split_threads
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -20,27 +23,47 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
 parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
 parser.add_argument('-N', '--no-dry-run', help='Don\'t just show changes but also save them to netbox', action='store_true')
+add_fetch_arguments(parser)
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
-vm_ifaces = nb.virtualization.interfaces.all()
-dev_ifaces = nb.dcim.interfaces.all()
-for iface in vm_ifaces:
+# vms and addresses of vm interfaces in bulk, joined locally.
+# threads are split among both lists.
+each = split_threads(args.threads, 2)
+data = parallel({
+  'vms': lambda: fetch_all(nb.virtualization.virtual_machines, each, **projection(['name', 'primary_ip4'])),
+  'ips': lambda: fetch_all(nb.ipam.ip_addresses, each, assigned_object_type='virtualization.vminterface', **projection(['display', 'dns_name', 'assigned_object'])),
+}, args.threads)
+ips = {x.id: x for x in data['ips']}
 
-    # load primary ip 
-    iface.virtual_machine.full_details()
-    ip = iface.virtual_machine.primary_ip4
-    ip.full_details()
+# primary ips not assigned to vm interface (eg. device interface)
+missing = set(vm.primary_ip4.id for vm in data['vms'] if vm.primary_ip4 and vm.primary_ip4.id not in ips)
+for ip in fetch_by_ids(nb.ipam.ip_addresses, missing, **projection(['display', 'dns_name', 'assigned_object'])):
+    ips[ip.id] = ip
+
+# one dns_name change per primary ip
+updates = {}
+for vm in data['vms']:
+    if not vm.primary_ip4:
+        debug(vm.name, "has no primary ip, skipping")
+        continue
+    ip = ips.get(vm.primary_ip4.id)
+    if not ip:
+        warn(vm.name, "primary ip deleted meanwhile, skipping")
+        continue
+    ifname = ip.assigned_object.name if ip.assigned_object else None
 
     # determine name consistency
-    ifname = iface.virtual_machine.name
+    vmname = vm.name
     ipname = ip.dns_name
-    if ifname != ipname:
-        warn(iface.virtual_machine.name, "rename", iface.name, ip.display, ipname, '->', ifname)
-        if args.no_dry_run:
-            ip.dns_name = ifname
-            ip.save()
+    if vmname != ipname:
+        warn(vm.name, "rename", ifname, ip.display, ipname, '->', vmname)
+        updates[ip.id] = {'id': ip.id, 'dns_name': vmname}
     else:
-        debug(iface.virtual_machine.name, "is consistent")
+        debug(vm.name, "is consistent")
 
+# bulk PATCH in chunks
+if args.no_dry_run:
+    for chunk in chunks(updates.values()):
+        nb.ipam.ip_addresses.update(chunk)
@@ -3,8 +3,13 @@
 from sys import stderr,exit,argv
 import json,yaml,os,ipaddress,random,pynetbox,argparse,re
 import requests as req
+from itertools import chain
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
+from netbox_tools.fetch import add_fetch_arguments, fetch_all, projection
+from netbox_tools.pipeline import parallel, split_threads
+from netbox_tools.reconcile import prefixes_by_vlan, description_changes, apply_changes
 
 def fail(*messages):
   print(*messages, file=stderr)
@@ -19,45 +24,68 @@ def debug(*messages):
 parser = argparse.ArgumentParser()
 parser.add_argument('-T', '--token', help='Netbox API Token (defaults to NETBOX_TOKEN env)', default=os.getenv('NETBOX_TOKEN'))
 parser.add_argument('-A', '--api-url', help='Netbox API URL (defaults to NETBOX_API_URL env)', default=os.getenv('NETBOX_API_URL'))
-parser.add_argument('-t', '--tenant', help='Tenant name (defaults to NETBOX_DEFAULT_TENANT env)', default=os.getenv('NETBOX_DEFAULT_TENANT'))
+parser.add_argument('-t', '--tenant', help='Tenant slug (defaults to NETBOX_DEFAULT_TENANT env)', default=os.getenv('NETBOX_DEFAULT_TENANT'))
 parser.add_argument('-s', '--site', help='Site name (eg. \'dc\')')
 parser.add_argument('-N', '--no-dry-run', help='Don\'t just show changes but also save them to netbox', action='store_true')
 parser.add_argument('-X', '--show-candidates', help='Show name candidates and exit without doint anything.', action='store_true')
+add_fetch_arguments(parser)
 args = parser.parse_args()
 
-# get all VLANs
-nb = pynetbox.api(args.api_url, args.token)
-vlans = nb.ipam.vlans.all()
+nb = connect(args.api_url, args.token)
 
-nets = nb.ipam.prefixes.all()
-for net in nets:
-  if not net.vlan:
-    warn('!! network without vlan', net)
+# vlans of site and tenant, filtered on server
+filters = projection(['vid', 'name'])
+if args.site:
+  filters['site'] = args.site.lower()
+if args.tenant:
+  filters['tenant'] = args.tenant.lower()
 
+# vlans the filters skip for lack of site or tenant, only to warn about them
+skipped = {}
+if args.site:
+  skipped['without_site'] = dict(projection(['vid', 'name']), site_id='null')
+if args.tenant:
+  skipped['without_tenant'] = {k: v for k, v in filters.items() if k != 'tenant'}
+  skipped['without_tenant']['tenant_id'] = 'null'
+
+# get VLANs and prefixes at once, threads are split among all lists
+each = split_threads(args.threads, 2 + len(skipped))
+tasks = {
+  'vlans': lambda: fetch_all(nb.ipam.vlans, each, **filters),
+  'prefixes': lambda: prefixes_by_vlan(nb, threads=each),
+}
+for name, skip_filters in skipped.items():
+  tasks[name] = lambda skip_filters=skip_filters: fetch_all(nb.ipam.vlans, each, **skip_filters)
+data = parallel(tasks, args.threads)
+vlans = data['vlans']
+nets, without_vlan = data['prefixes']
+
+for net in without_vlan:
+  warn('!! network without vlan', net)
+for vlan in data.get('without_site', []):
+  warn('!! vlan without site', vlan.vid, vlan)
+for vlan in data.get('without_tenant', []):
+  warn('!! vlan without tenant', vlan.vid, vlan)
+
+# prefixes by vid of their vlan. vlan is matched to single prefix with its
+# vid, vlan with more of them is reported and skipped.
+nets_by_vid = {}
+for net in chain.from_iterable(nets.values()):
+  nets_by_vid.setdefault(net.vlan.vid, []).append(net)
+
+pairs = []
 for vlan in vlans:
-  # filtering functionality
-  if args.site:
-    if not vlan.site:
-      warn('!! vlan without site', vlan.vid, vlan)
-      continue
-    if args.site.lower() != vlan.site.slug.lower():
-      #debug('skip', vlan.name, 'because of site filter', vlan.site, args.site)
-      continue
-  if args.tenant:
-    if not vlan.tenant:
-      warn('!! vlan without tenant', vlan.vid, vlan)
-      continue
-    if args.tenant.lower() != vlan.tenant.slug.lower():
-      #debug('skip', vlan.name, 'because of tenant filter', vlan.tenant, args.tenant)
-      continue
-
-  net = nb.ipam.prefixes.get(vlan_vid=vlan.vid)
-  if not net:
+  matching = nets_by_vid.get(vlan.vid, [])
+  if not matching:
     warn('!! no network associated with vlan', vlan.vid, vlan)
     continue
+  if len(matching) > 1:
+    warn('!! more networks associated with vlan', vlan.vid, vlan, *matching)
+    continue
+  pairs.append((matching[0], vlan.name))
 
-  if vlan.name != net.description:
-    warn('rename',net,net.description,'->',vlan.name)
-    if args.no_dry_run:
-      net.description = vlan.name
-      net.save()
+changes = description_changes(pairs)
+for net, old, new in changes:
+  warn('rename',net,old,'->',new)
+if args.no_dry_run:
+  apply_changes(nb.ipam.prefixes, changes)
@@ -5,6 +5,7 @@ import json,yaml,os,ipaddress,random,pynetbox,argparse
 import requests as req
 from pprint import pprint
 from uuid import uuid4
+from netbox_tools.client import connect
 
 # display error & bail out
 def fail(*messages):
@@ -27,7 +28,7 @@ if __name__ == "__main__":
   parser.add_argument('-Y', '--tmp-name', help='TMP old name')
   args = parser.parse_args()
 
-  nb = pynetbox.api(args.api_url, args.token)
+  nb = connect(args.api_url, args.token)
 
   # pre-validate inputs
   if args.type not in ['multipath','drbd','lvm']:
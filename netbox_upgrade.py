@@ -2,6 +2,7 @@
 
 from sys import stderr,exit
 import json, os, pynetbox, re, datetime, argparse
+from netbox_tools.client import connect
 
 def debug(*msg):
   return
@@ -23,7 +24,7 @@ parser.add_argument('fqdn', help='FQDN associated with VM or Device')
 
 args = parser.parse_args()
 
-nb = pynetbox.api(args.api_url, args.token)
+nb = connect(args.api_url, args.token)
 
 dev = None
 vm = None